@@ -1,60 +1,38 @@
-import random
+#one-character-per-symbol grammars ("S -> 60 S") with the old gengramparser api,
+#kept so scripts written against it keep working; the engine is gengramparser2's "char" dialect
 import sys
 
-class GrammarRule:
-    def __init__(self, lhs, rhs):
-        self.lhs = lhs
-        self.rhs = rhs
+import gengramparser2 as ggp2
 
-    def __str__(self):
-        return self.lhs + " -> " + self.rhs
+class GrammarRule(ggp2.GrammarRule):
+    def __init__(self, lhs, rhs, weight=1.0, line=None):
+        super().__init__(lhs, rhs, weight, line, "char")
 
-    def __repr__(self):
-        return self.__str__()
-
-class Grammar:
+class Grammar(ggp2.Grammar):
     def __init__(self):
-        self.rules = []
-
-    def add_rule(self, rule):
-        self.rules.append(rule)
-
-    def __str__(self):
-        return "\n".join(map(str, self.rules))
-
-    def __repr__(self):
-        return self.__str__()
+        super().__init__("char")
 
 def parse_grammar(f):
-    grammar = Grammar()
-    for line in f:
-        line = line.strip()
-        if line:
-            lhs, rhs_alternatives = line.split("->")
-            lhs = lhs.strip()
-            alternatives = rhs_alternatives.split("|")
-            alternatives = [alt.strip() for alt in alternatives]
-            for alternative in alternatives:
-                grammar.add_rule(GrammarRule(lhs, alternative))
-    return grammar
+    return ggp2.parse_grammar(f, dialect="char")
+
+def compile_grammar(grammar, start="S"):
+    # CompiledGrammar for grammar, kept on it until another rule is added
+    key = (len(grammar.rules), start)
+    cached = grammar.__dict__.get("_compiled")
+    if cached is None or cached[0] != key:
+        cached = grammar._compiled = (key, ggp2.compile_grammar(grammar, start))
+    return cached[1]
 
 def generate_from_symbol(grammar, symbol):
-    options = [rule.rhs for rule in grammar.rules if rule.lhs == symbol]
-    if options:
-        return random.choice(options)
-    return symbol
+    return ggp2.generate_from_symbol(grammar, symbol)
 
 def generate_from_string(grammar, string):
-    output = ""
-    for symbol in string:
-        output += generate_from_symbol(grammar, symbol)
-    return output
+    # one rewriting pass over every character of string
+    return "".join(ggp2.expand_tokens(grammar, ggp2.tokenize(string, "char"))[0])
 
 def generate(grammar, symbol, depth):
-    if depth == 0:
-        return symbol
-    else:
-        return generate(grammar, generate_from_string(grammar, symbol), depth - 1)
+    # at most depth rewriting passes, stopping early once no character has rules
+    return ggp2.generate_compiled(compile_grammar(grammar, symbol), symbol, depth)
 
 if __name__ == "__main__":
     if len(sys.argv) != 3:
@@ -64,7 +42,6 @@ if __name__ == "__main__":
     grammar_file = sys.argv[1]
     depth = int(sys.argv[2])
 
-    with open(grammar_file) as f:
-        grammar = parse_grammar(f)
-        print(grammar)
-        print(generate(grammar, "S", depth))
+    grammar, compiled = ggp2.load_grammar_file(grammar_file, "S", dialect="char")
+    print(grammar)
+    print(ggp2.generate_compiled(compiled, "S", depth))
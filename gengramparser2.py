@@ -1,58 +1,1367 @@
+import bisect
+import hashlib
+import math
+import os
+import pickle
 import random
+import re
 import sys
+import time
+import warnings
+from array import array
+from collections import OrderedDict, namedtuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import musical_scales
+except ImportError:
+    musical_scales = None
 
 DEBUG = False
+
+class GenerationError(ValueError):
+    # a grammar or generator setting that cannot produce the requested output
+    pass
+
+class BudgetExceededError(GenerationError):
+    # Raised by the derive_* drivers when a generation budget runs out.
+    # budget is "tokens", "passes" or "time" ("depth" for iter_generate),
+    # limit its configured value; passes is None for streamed derivations.
+    def __init__(self, budget, limit, passes, tokens, elapsed):
+        self.budget = budget
+        self.limit = limit
+        self.passes = passes
+        self.tokens = tokens
+        self.elapsed = elapsed
+        done = f"{tokens} tokens" if passes is None else f"{passes} passes, {tokens} tokens"
+        super().__init__(f"Generation aborted: {budget} budget of {limit} exceeded "
+                         f"after {done}, {elapsed:.2f} s.")
+
+class GrammarGrowthWarning(UserWarning):
+    pass
+
+class GenerationBudget:
+    # Limits for one derivation: output tokens, rewriting passes that still
+    # leave nonterminals behind, and wall-clock seconds. None means no limit.
+    def __init__(self, max_tokens=None, max_passes=None, max_time=None):
+        self.max_tokens = max_tokens
+        self.max_passes = max_passes
+        self.max_time = max_time
+        self.started = time.monotonic()
+
+    def exceeded(self, passes, tokens, unfinished):
+        # name of the first budget that ran out, or None; unfinished() tells
+        # whether nonterminals are left and is only called when needed
+        if self.max_tokens is not None and tokens > self.max_tokens:
+            return "tokens"
+        if self.max_passes is not None and passes >= self.max_passes and unfinished():
+            return "passes"
+        if self.max_time is not None and time.monotonic() - self.started > self.max_time:
+            return "time"
+        return None
+
+    def error(self, budget, passes, tokens):
+        limit = {"tokens": self.max_tokens, "passes": self.max_passes, "time": self.max_time}[budget]
+        return BudgetExceededError(budget, limit, passes, tokens, time.monotonic() - self.started)
+
+    def check(self, passes, tokens, unfinished):
+        budget = self.exceeded(passes, tokens, unfinished)
+        if budget:
+            raise self.error(budget, passes, tokens)
+
+# grammar dialects and the separator that joins their output tokens:
+# "dollar" grammars have whitespace-separated tokens with $-nonterminals,
+# "char" grammars (the older gengramparser format) make every character a
+# symbol, and every left-hand side a nonterminal that is rewritten in
+# parallel like an L-system
+DIALECTS = {"dollar": " ", "char": ""}
+
+# optional weight at the end of an alternative: "60 62 [3]"
+WEIGHT_PATTERN = re.compile(r"^(.*?)\s*\[\s*([-+0-9.eE]+)\s*\]$")
+
 class GrammarRule:
-    def __init__(self, lhs, rhs):
+    def __init__(self, lhs, rhs, weight=1.0, line=None, dialect="dollar"):
         self.lhs = lhs
         self.rhs = rhs
+        self.weight = weight
+        self.tokens = tuple(tokenize(rhs, dialect))
+        # source line number, for error messages
+        self.line = line
 
     def __str__(self):
+        if self.weight != 1.0:
+            return f"{self.lhs} -> {self.rhs} [{self.weight:g}]"
         return self.lhs + " -> " + self.rhs
 
     def __repr__(self):
         return self.__str__()
 
 class Grammar:
-    def __init__(self):
+    def __init__(self, dialect="dollar"):
+        self.dialect = dialect
         self.rules = []
+        # lhs -> list of rhs alternatives, kept in sync with self.rules
+        self.index = {}
+        # same alternatives, pre-split into token tuples for expand_tokens
+        self.token_index = {}
+        self.weight_index = {}
+        # lhs -> alias table, rebuilt lazily after add_rule touches the lhs
+        self.alias_tables = {}
+        # declared with "%type <name>", see TERMINAL_TYPES
+        self.terminal_type = None
 
     def add_rule(self, rule):
         self.rules.append(rule)
+        self.index.setdefault(rule.lhs, []).append(rule.rhs)
+        self.token_index.setdefault(rule.lhs, []).append(rule.tokens)
+        self.weight_index.setdefault(rule.lhs, []).append(rule.weight)
+        self.alias_tables.pop(rule.lhs, None)
+
+    def get_alias_table(self, symbol):
+        table = self.alias_tables.get(symbol)
+        if table is None:
+            table = self.alias_tables[symbol] = build_alias_table(self.weight_index[symbol], symbol)
+        return table
+
+    def choose_index(self, symbol, rng=None):
+        prob, alias = self.get_alias_table(symbol)
+        return sample_alias(prob, alias, (rng or random).random())
+
+    def get_alternatives(self, symbol):
+        return self.index.get(symbol, [])
+
+    def has_rules(self, symbol):
+        return symbol in self.index
+
+    def terminals(self):
+        # (token, rule) for every terminal on a right-hand side; undefined
+        # $-symbols stay in the output as they are, so they count too
+        for rule in self.rules:
+            for token in rule.tokens:
+                if token not in self.token_index:
+                    yield token, rule
 
     def __str__(self):
-        return "\n".join(map(str, self.rules))
+        lines = list(map(str, self.rules))
+        if self.terminal_type is not None:
+            lines.insert(0, f"%type {self.terminal_type}")
+        return "\n".join(lines)
 
     def __repr__(self):
         return self.__str__()
 
-def parse_grammar(f):
-    grammar = Grammar()
-    for line in f:
+def _midi_int(token):
+    value = int(token)
+    if not 0 <= value <= 127:
+        raise ValueError(f"{value} is outside the MIDI range 0..127")
+    return value
+
+def _duration(token):
+    value = float(token)
+    if not value >= 0:
+        raise ValueError(f"{value} is not a duration")
+    return value
+
+NOTE_DEFAULTS = (60, 1.0, 100)
+
+def _note(token):
+    # "pitch/duration/velocity"; trailing fields may be left out, e.g. "60/0.5"
+    fields = token.split("/")
+    if len(fields) > 3:
+        raise ValueError("a note has at most three fields, pitch/duration/velocity")
+    converters = (_midi_int, _duration, _midi_int)
+    return tuple(convert(field) for convert, field in zip(converters, fields)) + NOTE_DEFAULTS[len(fields):]
+
+# terminal type name -> (converter, array typecode or None for a plain list);
+# converters raise ValueError for tokens that are not values of the type
+TERMINAL_TYPES = {
+    "int": (int, "q"),
+    "float": (float, "d"),
+    "pitch": (_midi_int, "q"),
+    "velocity": (_midi_int, "q"),
+    "duration": (_duration, "d"),
+    "note": (_note, None),
+}
+
+def check_terminal_type(grammar, terminal_type):
+    # converted value of every terminal, or ValueError naming the first bad one
+    if terminal_type not in TERMINAL_TYPES:
+        raise ValueError(f"Unknown terminal type '{terminal_type}', use one of {', '.join(TERMINAL_TYPES)}.")
+    convert = TERMINAL_TYPES[terminal_type][0]
+    values = {}
+    for token, rule in grammar.terminals():
+        if token in values:
+            continue
+        try:
+            values[token] = convert(token)
+        except ValueError as e:
+            where = f"Line {rule.line}: " if rule.line is not None else ""
+            hint = " (undefined nonterminal?)" if token[0] == "$" else ""
+            raise ValueError(f"{where}terminal '{token}' in '{rule}' is not a {terminal_type} value{hint}: {e}") from None
+    return values
+
+def infer_terminal_type(grammar):
+    # "int" or "float" when every terminal reads as one, otherwise None
+    for terminal_type in ("int", "float"):
+        try:
+            check_terminal_type(grammar, terminal_type)
+        except ValueError:
+            continue
+        return terminal_type
+    return None
+
+def derive_rng(seed, *keys):
+    # Independent, reproducible random stream for (seed, *keys), e.g.
+    # derive_rng(seed, "bar", 3, "pitch"). The stream does not depend on how
+    # many numbers were drawn from any other stream, so work split across
+    # processes gives the same result as a serial run.
+    digest = hashlib.sha256(repr((seed,) + keys).encode()).digest()
+    return random.Random(int.from_bytes(digest[:8], "big"))
+
+def build_alias_table(weights, symbol="?"):
+    # Vose's alias method: after this O(n) setup an alternative is drawn in
+    # constant time with sample_alias(), however skewed the weights are.
+    count = len(weights)
+    total = float(sum(weights))
+    if total <= 0:
+        raise ValueError(f"All alternatives of '{symbol}' have zero weight.")
+    prob = [weight * count / total for weight in weights]
+    alias = list(range(count))
+    small = [i for i, p in enumerate(prob) if p < 1.0]
+    large = [i for i, p in enumerate(prob) if p >= 1.0]
+    while small and large:
+        less = small.pop()
+        more = large.pop()
+        alias[less] = more
+        prob[more] = prob[more] + prob[less] - 1.0
+        if prob[more] < 1.0:
+            small.append(more)
+        else:
+            large.append(more)
+    for i in small + large:
+        prob[i] = 1.0
+    return prob, alias
+
+def sample_alias(prob, alias, u):
+    # u is uniform in [0, 1); its integer part picks a column, the fraction
+    # decides between the column and its alias
+    u *= len(prob)
+    i = int(u)
+    if u - i < prob[i]:
+        return i
+    return alias[i]
+
+def split_weight(alternative):
+    match = WEIGHT_PATTERN.match(alternative)
+    if not match:
+        return alternative, 1.0
+    rhs, weight_text = match.groups()
+    try:
+        weight = float(weight_text)
+    except ValueError:
+        raise ValueError(f"Invalid weight '[{weight_text}]' in alternative '{alternative}'.") from None
+    if weight < 0:
+        raise ValueError(f"Negative weight '[{weight_text}]' in alternative '{alternative}'.")
+    return rhs, weight
+
+# operators inside a rule, rewritten by expand_operator into generated rules:
+# {60..72} or {60..72..2} (every number in the range), {D3:dorian} or
+# {D3:dorian:2} (the MIDI numbers of a musical_scales scale, middle C = C3 =
+# 60, "_" for spaces in mode names) and X*4 (X four times over)
+RANGE_PATTERN = re.compile(r"^\{(-?\d+)\.\.(-?\d+)(?:\.\.(\d+))?\}$")
+SCALE_PATTERN = re.compile(r"^\{([A-Ga-g][#b]?-?\d*):([A-Za-z_-]+)(?::(\d+))?\}$")
+REPEAT_PATTERN = re.compile(r"^(.+)\*(\d+)$")
+
+def expand_operator(token, grammar, line=None):
+    # The token to use in place of token. Ranges and scales become a $-named
+    # rule with one alternative per value, added to grammar on first use;
+    # X*n becomes a chain of doubling rules ($X*4 -> $X*2 $X*2,
+    # $X*2 -> X X), so n copies take O(log n) rule symbols.
+    where = f"Line {line}: " if line is not None else ""
+    match = REPEAT_PATTERN.match(token)
+    if match:
+        base = expand_operator(match.group(1), grammar, line)
+        count = int(match.group(2))
+        if count == 0:
+            raise ValueError(f"{where}repeat count of '{token}' must be at least 1.")
+        return _repeat(base, count, grammar, line)
+    if token[0] != "{":
+        return token
+    name = "$" + token
+    if name in grammar.token_index:
+        return name
+    match = RANGE_PATTERN.match(token)
+    if match:
+        low, high = int(match.group(1)), int(match.group(2))
+        step = int(match.group(3) or 1)
+        if low > high or step == 0:
+            raise ValueError(f"{where}empty range '{token}'.")
+        values = [str(value) for value in range(low, high + 1, step)]
+    else:
+        match = SCALE_PATTERN.match(token)
+        if not match:
+            raise ValueError(f"{where}unknown operator '{token}', expected {{60..72}}, {{D3:dorian}} or X*n.")
+        if musical_scales is None:
+            raise ValueError(f"{where}scale '{token}' needs the musical_scales package.")
+        root, mode, octaves = match.group(1), match.group(2).replace("_", " "), int(match.group(3) or 1)
+        try:
+            notes = musical_scales.scale(root, mode, octaves=octaves)
+        except musical_scales.MusicException as e:
+            raise ValueError(f"{where}bad scale '{token}': {e}") from None
+        values = [str(60 + note.semitones_above_middle_c) for note in notes]
+    for value in values:
+        grammar.add_rule(GrammarRule(name, value, 1.0, line))
+    return name
+
+def _repeat(base, count, grammar, line):
+    if count == 1:
+        return base
+    name = f"{base if base[0] == '$' else '$' + base}*{count}"
+    if name not in grammar.token_index:
+        half = _repeat(base, count // 2, grammar, line)
+        rhs = f"{half} {half}" if count % 2 == 0 else f"{_repeat(base, count - 1, grammar, line)} {base}"
+        grammar.add_rule(GrammarRule(name, rhs, 1.0, line))
+    return name
+
+def parse_grammar(f, lsystem=False, dialect="dollar"):
+    # lsystem grammars are rewritten in parallel a fixed number of times
+    # (see LSystem), so left recursion and unbounded growth are fine there.
+    # "char" grammars are rewritten the same way and take every alternative
+    # literally: no weights, operators or directives.
+    if dialect not in DIALECTS:
+        raise ValueError(f"Unknown grammar dialect '{dialect}', use one of {', '.join(DIALECTS)}.")
+    char = dialect == "char"
+    lsystem = lsystem or char
+    grammar = Grammar(dialect)
+    for line_number, line in enumerate(f, 1):
         line = line.strip()
-        if line:
+        if line.startswith("%") and not char:
+            directive = line.split()
+            if directive[0] != "%type" or len(directive) != 2 or directive[1] not in TERMINAL_TYPES:
+                raise ValueError(f"Line {line_number}: bad directive '{line}', "
+                                 f"expected '%type <{'|'.join(TERMINAL_TYPES)}>'.")
+            grammar.terminal_type = directive[1]
+        elif line:
             lhs, rhs_alternatives = line.split("->")
             lhs = lhs.strip()
             alternatives = rhs_alternatives.split("|")
             alternatives = [alt.strip() for alt in alternatives]
             for alternative in alternatives:
+                if char:
+                    grammar.add_rule(GrammarRule(lhs, alternative, 1.0, line_number, dialect))
+                    continue
+                alternative, weight = split_weight(alternative)
+                if "{" in alternative or "*" in alternative:
+                    alternative = " ".join(expand_operator(token, grammar, line_number)
+                                           for token in alternative.split())
                 # Check for direct left recursion: LHS cannot be the first symbol on RHS
                 rhs_first_symbol = alternative.split()[0] if alternative.split() else ""
-                if rhs_first_symbol == lhs:
+                if rhs_first_symbol == lhs and not lsystem:
                     raise ValueError(f"Infinite recursion detected: '{lhs} -> {alternative}'. "
                                    f"The non-terminal '{lhs}' cannot appear as the first symbol on the right side of its own rule.")
-                grammar.add_rule(GrammarRule(lhs, alternative))
+                grammar.add_rule(GrammarRule(lhs, alternative, weight, line_number))
+    if grammar.terminal_type is not None:
+        check_terminal_type(grammar, grammar.terminal_type)
+    grammar.divergent = find_divergent_nonterminals(grammar) if not lsystem else []
+    if grammar.divergent:
+        warnings.warn(f"Expected expansion size diverges for {', '.join(grammar.divergent)}; "
+                      f"generation may grow without bound.", GrammarGrowthWarning, stacklevel=2)
     if DEBUG:
         print(grammar)
     return grammar
 
-def generate_from_symbol(grammar, symbol):
-    options = [rule.rhs for rule in grammar.rules if rule.lhs == symbol]
+def expected_sizes(grammar):
+    # Expected number of terminals each nonterminal expands to when
+    # alternatives are drawn by weight; math.inf where that expectation
+    # diverges (rules that on average reproduce their nonterminals at least
+    # as fast as they finish them, like "$S -> 60 $S $S | 61").
+    # The sizes solve s = b + M s, where b[A] is the expected number of
+    # terminals in one expansion of A and M[A][B] the expected number of B.
+    # Each strongly connected group of nonterminals is solved once its
+    # successors are known, by elimination on I - M: that is a Z-matrix, so
+    # the spectral radius of M is below 1 exactly when every pivot is
+    # positive, and a pivot that is not means the group diverges.
+    nonterminals = [lhs for lhs in grammar.token_index if lhs[0] == "$"]
+    terminals = {}
+    uses = {}
+    for lhs in nonterminals:
+        total = float(sum(grammar.weight_index[lhs]))
+        b = 0.0
+        row = {}
+        for tokens, weight in zip(grammar.token_index[lhs], grammar.weight_index[lhs]):
+            p = weight / total if total else 0.0
+            if not p:
+                continue
+            for token in tokens:
+                if token in grammar.token_index and token[0] == "$":
+                    row[token] = row.get(token, 0.0) + p
+                else:
+                    b += p
+        terminals[lhs] = b
+        uses[lhs] = row
+    sizes = {}
+    for group in _strong_components(nonterminals, uses):
+        members = set(group)
+        b = [terminals[lhs] for lhs in group]
+        infinite = False
+        for k, lhs in enumerate(group):
+            for symbol, count in uses[lhs].items():
+                if symbol not in members:
+                    b[k] += count * sizes[symbol]
+            infinite = infinite or b[k] == math.inf
+        n = len(group)
+        a = [[(1.0 if j == k else 0.0) - uses[lhs].get(other, 0.0) for j, other in enumerate(group)]
+             for k, lhs in enumerate(group)]
+        for k in range(n):
+            if infinite:
+                break
+            pivot = a[k][k]
+            if pivot <= 1e-9:
+                infinite = True
+                break
+            for r in range(k + 1, n):
+                factor = a[r][k] / pivot
+                if factor:
+                    for c in range(k, n):
+                        a[r][c] -= factor * a[k][c]
+                    b[r] -= factor * b[k]
+        if infinite:
+            sizes.update(dict.fromkeys(group, math.inf))
+            continue
+        solution = [0.0] * n
+        for k in range(n - 1, -1, -1):
+            solution[k] = (b[k] - sum(a[k][c] * solution[c] for c in range(k + 1, n))) / a[k][k]
+        for lhs, size in zip(group, solution):
+            sizes[lhs] = size if size <= 1e12 else math.inf
+    return {lhs: sizes[lhs] for lhs in nonterminals}
+
+def _strong_components(nodes, edges):
+    # Tarjan's algorithm without recursion; components come out successors
+    # first, so each one only refers to components already returned
+    index = {}
+    low = {}
+    stack = []
+    on_stack = set()
+    components = []
+    for root in nodes:
+        if root in index:
+            continue
+        work = [(root, iter(edges[root]))]
+        index[root] = low[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        while work:
+            node, successors = work[-1]
+            for successor in successors:
+                if successor not in index:
+                    index[successor] = low[successor] = len(index)
+                    stack.append(successor)
+                    on_stack.add(successor)
+                    work.append((successor, iter(edges[successor])))
+                    break
+                if successor in on_stack:
+                    low[node] = min(low[node], index[successor])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[node])
+                if low[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(component)
+    return components
+
+def find_divergent_nonterminals(grammar):
+    return sorted(lhs for lhs, size in expected_sizes(grammar).items() if size == math.inf)
+
+class CompiledGrammar:
+    # Integer form of a Grammar. Nonterminals get the ids 0..num_nonterminals-1
+    # and terminals the ids after them. The alternatives of nonterminal A are
+    # alt_offsets[A]..alt_offsets[A+1]-1 and the symbols of alternative k are
+    # rhs[rhs_offsets[k]:rhs_offsets[k+1]]. weights, alias_prob and
+    # alias_index are indexed by alternative; alias_index holds the position of
+    # the alias within its nonterminal. Only the flat arrays are pickled.
+    # With a terminal_type, values[i] is the number terminal i stands for
+    # (0 for nonterminals), so derivations turn into numbers by lookup.
+    def __init__(self, symbols, num_nonterminals, alt_offsets, rhs_offsets, rhs, weights,
+                 terminal_type=None, values=None, dialect="dollar"):
+        self.symbols = symbols
+        self.num_nonterminals = num_nonterminals
+        self.alt_offsets = alt_offsets
+        self.rhs_offsets = rhs_offsets
+        self.rhs = rhs
+        self.weights = weights
+        self.terminal_type = terminal_type
+        self.values = values
+        self.dialect = dialect
+        self.alias_prob = array("d")
+        self.alias_index = array("i")
+        for nt in range(num_nonterminals):
+            prob, alias = build_alias_table(weights[alt_offsets[nt]:alt_offsets[nt + 1]], symbols[nt])
+            self.alias_prob.extend(prob)
+            self.alias_index.extend(alias)
+        self._build_lookups()
+
+    def _build_lookups(self):
+        self.symbol_ids = {symbol: i for i, symbol in enumerate(self.symbols)}
+        rhs, rhs_offsets = self.rhs, self.rhs_offsets
+        self.alternatives = [tuple(rhs[rhs_offsets[k]:rhs_offsets[k + 1]])
+                             for k in range(len(rhs_offsets) - 1)]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["symbol_ids"]
+        del state["alternatives"]
+        state.pop("_numpy_tables", None)
+        state.pop("_length_analysis", None)
+        state.pop("_derivation_counts", None)
+        state.pop("_derivation_alternatives", None)
+        state.pop("_optimized", None)
+        state.pop("_length_cache", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._build_lookups()
+
+    def is_nonterminal(self, symbol_id):
+        return symbol_id < self.num_nonterminals
+
+    def numpy_tables(self):
+        # alt_offsets, alias_prob and alias_index as NumPy arrays, built on first use
+        tables = self.__dict__.get("_numpy_tables")
+        if tables is None:
+            tables = self._numpy_tables = (np.frombuffer(self.alt_offsets, dtype=np.int32).astype(np.int64),
+                                           np.frombuffer(self.alias_prob, dtype=np.float64),
+                                           np.frombuffer(self.alias_index, dtype=np.int32).astype(np.int64))
+        return tables
+
+    def choose(self, nt, u):
+        # alternative index for nonterminal nt given a uniform draw u
+        first = self.alt_offsets[nt]
+        u *= self.alt_offsets[nt + 1] - first
+        i = int(u)
+        if u - i < self.alias_prob[first + i]:
+            return first + i
+        return first + self.alias_index[first + i]
+
+    def encode(self, tokens):
+        try:
+            return [self.symbol_ids[token] for token in tokens]
+        except KeyError as e:
+            raise ValueError(f"Unknown symbol {e.args[0]!r} for this grammar.") from None
+
+    def decode(self, ids):
+        symbols = self.symbols
+        return [symbols[i] for i in ids]
+
+    def decode_values(self, ids):
+        # values of terminal ids, for grammars with a terminal type
+        if self.values is None:
+            raise ValueError("Grammar has no numeric terminal type.")
+        values = self.values
+        return [values[i] for i in ids]
+
+    def __str__(self):
+        lines = []
+        for nt in range(self.num_nonterminals):
+            alternatives = []
+            for k in range(self.alt_offsets[nt], self.alt_offsets[nt + 1]):
+                alternative = DIALECTS[self.dialect].join(self.decode(self.alternatives[k]))
+                if self.weights[k] != 1.0:
+                    alternative += f" [{self.weights[k]:g}]"
+                alternatives.append(alternative)
+            lines.append(self.symbols[nt] + " -> " + " | ".join(alternatives))
+        return "\n".join(lines)
+
+    def __repr__(self):
+        return f"<CompiledGrammar {self.num_nonterminals} nonterminals, {len(self.symbols) - self.num_nonterminals} terminals, {len(self.alternatives)} alternatives>"
+
+def compile_grammar(grammar, start="$S", terminal_type=None, lsystem=False):
+    # terminal_type overrides the grammar's %type; without either it is
+    # inferred from the terminals (None for non-numeric grammars). With
+    # lsystem every symbol that has rules is a nonterminal, not just $-names;
+    # "char" grammars are always compiled that way and never infer a type.
+    dialect = grammar.dialect
+    lsystem = lsystem or dialect == "char"
+    terminal_type = terminal_type or grammar.terminal_type or (infer_terminal_type(grammar) if not lsystem else None)
+    converted = check_terminal_type(grammar, terminal_type) if terminal_type else None
+    nonterminals = [lhs for lhs in grammar.token_index if lsystem or lhs[0] == "$"]
+    symbols = list(nonterminals)
+    symbol_ids = {symbol: i for i, symbol in enumerate(symbols)}
+
+    def intern(symbol):
+        symbol_id = symbol_ids.get(symbol)
+        if symbol_id is None:
+            symbol_id = symbol_ids[symbol] = len(symbols)
+            symbols.append(symbol)
+        return symbol_id
+
+    # the start symbols always get an id, even when they have no rules
+    for token in tokenize(start, dialect):
+        intern(token)
+    alt_offsets = array("i", [0])
+    rhs_offsets = array("i", [0])
+    rhs = array("i")
+    weights = array("d")
+    for lhs in nonterminals:
+        for tokens in grammar.token_index[lhs]:
+            rhs.extend(intern(token) for token in tokens)
+            rhs_offsets.append(len(rhs))
+        weights.extend(grammar.weight_index[lhs])
+        alt_offsets.append(len(rhs_offsets) - 1)
+    values = None
+    if terminal_type:
+        # undefined start symbols are the only terminals the rules do not mention
+        for token in tokenize(start, dialect):
+            if token not in converted and token not in grammar.token_index:
+                converted[token] = TERMINAL_TYPES[terminal_type][0](token) if token[0] != "$" else 0
+        typecode = TERMINAL_TYPES[terminal_type][1]
+        values = array(typecode, [0] * len(nonterminals)) if typecode else [None] * len(nonterminals)
+        values.extend(converted[symbol] for symbol in symbols[len(nonterminals):])
+    return CompiledGrammar(symbols, len(nonterminals), alt_offsets, rhs_offsets, rhs, weights,
+                           terminal_type, values, dialect)
+
+EVEN, ODD = 1, 2
+
+class LengthAnalysis:
+    # Static facts about the lengths of the terminal strings each nonterminal
+    # can derive: the shortest (math.inf if it can never finish), the longest
+    # (math.inf if it can grow without limit) and the possible parities as a
+    # bit mask of EVEN and ODD. Symbols are given by name.
+    def __init__(self, compiled, min_lengths, max_lengths, parities):
+        self.compiled = compiled
+        self.min_lengths = min_lengths
+        self.max_lengths = max_lengths
+        self.parities = parities
+
+    def _lookup(self, table, symbol, terminal_value):
+        symbol_id = self.compiled.symbol_ids.get(symbol)
+        if symbol_id is None or not self.compiled.is_nonterminal(symbol_id):
+            return terminal_value
+        return table[symbol_id]
+
+    def min_length(self, symbol):
+        return self._lookup(self.min_lengths, symbol, 1)
+
+    def max_length(self, symbol):
+        return self._lookup(self.max_lengths, symbol, 1)
+
+    def parity(self, symbol):
+        return self._lookup(self.parities, symbol, ODD)
+
+    def possible_lengths(self, symbol, limit):
+        # every length <= limit that symbol can derive, in increasing order
+        bits = possible_length_bits(self.compiled, limit)
+        symbol_id = self.compiled.symbol_ids.get(symbol)
+        if symbol_id is None or not self.compiled.is_nonterminal(symbol_id):
+            mask = 1 << 1
+        else:
+            mask = bits[symbol_id]
+        return [length for length in range(limit + 1) if mask >> length & 1]
+
+def _alternative_symbols(compiled, k):
+    # (number of terminals, nonterminal ids) of alternative k
+    nonterminals = [s for s in compiled.alternatives[k] if s < compiled.num_nonterminals]
+    return len(compiled.alternatives[k]) - len(nonterminals), nonterminals
+
+def _weighted_alternatives(compiled, nt):
+    # alternatives of nt that can be drawn; [0]-weighted ones never are
+    return [k for k in range(compiled.alt_offsets[nt], compiled.alt_offsets[nt + 1]) if compiled.weights[k] > 0]
+
+def analyze_lengths(compiled):
+    # Fixed-point passes over the compiled rules. Cached on the compiled grammar.
+    analysis = compiled.__dict__.get("_length_analysis")
+    if analysis is not None:
+        return analysis
+    n = compiled.num_nonterminals
+    alts = [[_alternative_symbols(compiled, k) for k in _weighted_alternatives(compiled, nt)] for nt in range(n)]
+
+    min_lengths = [math.inf] * n
+    changed = True
+    while changed:
+        changed = False
+        for nt in range(n):
+            best = min((terminals + sum(min_lengths[x] for x in nts) for terminals, nts in alts[nt]), default=math.inf)
+            if best < min_lengths[nt]:
+                min_lengths[nt] = best
+                changed = True
+
+    # Longest derivation: a finite maximum is reached by a tree of height at
+    # most n, so anything still growing after n + 1 sweeps can grow forever.
+    max_lengths = [-1] * n
+    for sweep in range(n + 2):
+        growing = []
+        for nt in range(n):
+            for terminals, nts in alts[nt]:
+                if any(max_lengths[x] < 0 for x in nts):
+                    continue
+                total = terminals + sum(max_lengths[x] for x in nts)
+                if total > max_lengths[nt]:
+                    max_lengths[nt] = total
+                    growing.append(nt)
+        if not growing:
+            break
+        if sweep == n + 1:
+            for nt in growing:
+                max_lengths[nt] = math.inf
+            # let the unbounded values reach everything that uses them
+            changed = True
+            while changed:
+                changed = False
+                for nt in range(n):
+                    if max_lengths[nt] != math.inf and any(
+                            math.inf in [max_lengths[x] for x in nts] and all(max_lengths[x] >= 0 for x in nts)
+                            for _, nts in alts[nt]):
+                        max_lengths[nt] = math.inf
+                        changed = True
+    max_lengths = [length if length >= 0 else math.inf for length in max_lengths]
+    for nt in range(n):
+        if min_lengths[nt] == math.inf:
+            max_lengths[nt] = math.inf
+
+    parities = [0] * n
+    changed = True
+    while changed:
+        changed = False
+        for nt in range(n):
+            mask = parities[nt]
+            for terminals, nts in alts[nt]:
+                combined = ODD if terminals % 2 else EVEN
+                for x in nts:
+                    other = parities[x]
+                    result = 0
+                    if combined & EVEN:
+                        result |= other
+                    if combined & ODD:
+                        result |= (EVEN if other & ODD else 0) | (ODD if other & EVEN else 0)
+                    combined = result
+                mask |= combined
+            if mask != parities[nt]:
+                parities[nt] = mask
+                changed = True
+
+    analysis = compiled._length_analysis = LengthAnalysis(compiled, min_lengths, max_lengths, parities)
+    return analysis
+
+def _length_cache(compiled):
+    # results of the length analyses below, keyed by function and arguments;
+    # kept on the compiled grammar (like _length_analysis) so generators
+    # built from a cached grammar do not repeat them
+    return compiled.__dict__.setdefault("_length_cache", {})
+
+def possible_length_bits(compiled, limit):
+    # per nonterminal id, a bit set of the derivable lengths up to limit
+    cache = _length_cache(compiled)
+    bits = cache.get(("bits", limit))
+    if bits is None:
+        bits = cache[("bits", limit)] = _possible_length_bits(compiled, limit)
+    return bits
+
+def _possible_length_bits(compiled, limit):
+    n = compiled.num_nonterminals
+    full = (1 << (limit + 1)) - 1
+    alts = [[_alternative_symbols(compiled, k) for k in _weighted_alternatives(compiled, nt)] for nt in range(n)]
+    bits = [0] * n
+    changed = True
+    while changed:
+        changed = False
+        for nt in range(n):
+            mask = bits[nt]
+            for terminals, nts in alts[nt]:
+                combined = (1 << terminals) & full
+                for x in nts:
+                    result = 0
+                    other = bits[x]
+                    length = 0
+                    while other >> length:
+                        if other >> length & 1:
+                            result |= combined << length
+                        length += 1
+                    combined = result & full
+                mask |= combined
+            if mask != bits[nt]:
+                bits[nt] = mask
+                changed = True
+    return bits
+
+def length_distribution(compiled, symbol, limit, tolerance=1e-9):
+    # {length: probability} of the lengths <= limit that a derivation from
+    # symbol ends with, sampling alternatives by weight. The mass above limit
+    # (and of derivations that never finish) is whatever the values miss of 1.
+    symbol_id = compiled.symbol_ids.get(symbol)
+    if symbol_id is None or not compiled.is_nonterminal(symbol_id):
+        return {1: 1.0}
+    return _length_tables(compiled, limit, tolerance)[symbol_id]
+
+def _length_tables(compiled, limit, tolerance=1e-9):
+    # length_distribution() for every nonterminal id, by fixed-point sweeps
+    cache = _length_cache(compiled)
+    dists = cache.get(("tables", limit, tolerance))
+    if dists is None:
+        dists = cache[("tables", limit, tolerance)] = _sweep_length_tables(compiled, limit, tolerance)
+    return dists
+
+def _sweep_length_tables(compiled, limit, tolerance):
+    n = compiled.num_nonterminals
+    weights = compiled.weights
+    alts = []
+    for nt in range(n):
+        first, last = compiled.alt_offsets[nt], compiled.alt_offsets[nt + 1]
+        total = sum(weights[first:last])
+        alts.append([(weights[k] / total,) + _alternative_symbols(compiled, k)
+                     for k in _weighted_alternatives(compiled, nt)])
+    dists = [{} for _ in range(n)]
+    for sweep in range(4 * limit + 100):
+        change = 0.0
+        for nt in range(n):
+            dist = {}
+            for p, terminals, nts in alts[nt]:
+                if p == 0 or terminals > limit:
+                    continue
+                combined = {terminals: p}
+                for x in nts:
+                    combined = _convolve(combined, dists[x], limit)
+                    if not combined:
+                        break
+                for length, q in combined.items():
+                    dist[length] = dist.get(length, 0.0) + q
+            old = dists[nt]
+            # relative change, so that tiny probabilities of long outputs converge too
+            change = max([change] + [abs(q - old.get(length, 0.0)) / q for length, q in dist.items() if q])
+            dists[nt] = dist
+        if change < tolerance:
+            break
+    return dists
+
+def _convolve(a, b, limit):
+    result = {}
+    for la, pa in a.items():
+        for lb, pb in b.items():
+            length = la + lb
+            if length <= limit:
+                result[length] = result.get(length, 0.0) + pa * pb
+    return result
+
+def estimate_rejection_rate(compiled, symbol, min_length, limit=None):
+    # Share of derivations ListGenerator.generate_list would throw away for
+    # being shorter than min_length or odd. Exact below limit; mass above it
+    # is split by the parities the symbol can still produce.
+    cache = _length_cache(compiled)
+    key = ("rejection", symbol, min_length, limit)
+    rate = cache.get(key)
+    if rate is None:
+        rate = cache[key] = _rejection_rate(compiled, symbol, min_length, limit)
+    return rate
+
+def _rejection_rate(compiled, symbol, min_length, limit):
+    analysis = analyze_lengths(compiled)
+    if limit is None:
+        limit = max(2 * min_length, 64)
+    max_length = analysis.max_length(symbol)
+    if max_length != math.inf:
+        limit = int(max_length)
+    dist = length_distribution(compiled, symbol, limit)
+    accepted = sum(p for length, p in dist.items() if length >= min_length and length % 2 == 0)
+    if max_length == math.inf:
+        rest = max(0.0, 1.0 - sum(dist.values()))
+        parity = analysis.parity(symbol)
+        accepted += rest * (1.0 if parity == EVEN else 0.5 if parity == EVEN | ODD else 0.0)
+    return min(1.0, max(0.0, 1.0 - accepted))
+
+def _derivation_alternatives(compiled):
+    # Per nonterminal id, the alternative indices that derivation_counts
+    # and nth_derivation enumerate: zero-weight alternatives and ones that
+    # can never finish are skipped, and an alternative written twice for
+    # the same nonterminal is kept once, so the repeat does not count (and
+    # enumerate) every sequence it spells a second time.
+    alternatives = compiled.__dict__.get("_derivation_alternatives")
+    if alternatives is not None:
+        return alternatives
+    n = compiled.num_nonterminals
+    finite = analyze_lengths(compiled).min_lengths
+    alternatives = []
+    for nt in range(n):
+        seen = set()
+        kept = []
+        for k in _weighted_alternatives(compiled, nt):
+            alternative = compiled.alternatives[k]
+            if alternative not in seen and all(x >= n or finite[x] != math.inf for x in alternative):
+                seen.add(alternative)
+                kept.append(k)
+        alternatives.append(kept)
+    compiled._derivation_alternatives = alternatives
+    return alternatives
+
+def derivation_counts(compiled):
+    # Number of derivations (choice sequences) of each nonterminal id over
+    # _derivation_alternatives; math.inf for nonterminals that reach a
+    # recursive cycle. Repeated alternatives are merged, so in a grammar
+    # where each sequence has one derivation these are the numbers of
+    # distinct outputs; if two different alternatives can still spell the
+    # same sequence (e.g. "$S -> $A | 60" with "$A -> 60") it is an upper
+    # bound.
+    counts = compiled.__dict__.get("_derivation_counts")
+    if counts is not None:
+        return counts
+    n = compiled.num_nonterminals
+    usable = _derivation_alternatives(compiled)
+    uses = [set(x for k in usable[nt] for x in compiled.alternatives[k] if x < n) for nt in range(n)]
+
+    def reachable(nt):
+        seen, todo = set(), list(uses[nt])
+        while todo:
+            x = todo.pop()
+            if x not in seen:
+                seen.add(x)
+                todo.extend(uses[x])
+        return seen
+
+    reach = [reachable(nt) for nt in range(n)]
+    cyclic = {nt for nt in range(n) if nt in reach[nt]}
+    counts = [0] * n
+    for nt in range(n):
+        if nt in cyclic or reach[nt] & cyclic:
+            counts[nt] = math.inf
+    # what is left is acyclic: n sweeps settle it
+    for _ in range(n + 1):
+        changed = False
+        for nt in range(n):
+            if counts[nt] == math.inf:
+                continue
+            total = sum(math.prod(counts[x] if x < n else 1 for x in compiled.alternatives[k]) for k in usable[nt])
+            if total != counts[nt]:
+                counts[nt] = total
+                changed = True
+        if not changed:
+            break
+    compiled._derivation_counts = counts
+    return counts
+
+def _compiled(grammar, start):
+    return grammar if isinstance(grammar, CompiledGrammar) else compile_grammar(grammar, start)
+
+def count_derivations(grammar, symbol="$S"):
+    compiled = _compiled(grammar, symbol)
+    counts = derivation_counts(compiled)
+    n = compiled.num_nonterminals
+    return math.prod(counts[x] if x < n else 1 for x in compiled.encode(tokenize(symbol, compiled.dialect)))
+
+def nth_derivation(grammar, index, symbol="$S"):
+    # Tokens of derivation number index (0-based) in a fixed order, built
+    # directly from the counts without visiting the derivations before it.
+    # Alternatives are ordered as written, earlier symbols vary slowest.
+    compiled = _compiled(grammar, symbol)
+    counts = derivation_counts(compiled)
+    usable = _derivation_alternatives(compiled)
+    n = compiled.num_nonterminals
+    total = count_derivations(compiled, symbol)
+    if total == math.inf:
+        raise GenerationError(f"'{symbol}' has infinitely many derivations; only finite grammars can be enumerated.")
+    if not 0 <= index < total:
+        raise IndexError(f"derivation index {index} out of range for {total} derivations")
+
+    def split(symbols, index):
+        # mixed-radix digits of index, one per symbol, first symbol most significant
+        parts = []
+        for x in reversed(symbols):
+            radix = counts[x] if x < n else 1
+            index, digit = divmod(index, radix)
+            parts.append((x, digit))
+        return parts  # reversed: popping from the end gives the leftmost symbol
+
+    output = []
+    stack = split(compiled.encode(tokenize(symbol, compiled.dialect)), index)
+    while stack:
+        symbol_id, index = stack.pop()
+        if symbol_id >= n:
+            output.append(compiled.symbols[symbol_id])
+            continue
+        for k in usable[symbol_id]:
+            alternative = compiled.alternatives[k]
+            size = math.prod(counts[x] if x < n else 1 for x in alternative)
+            if index < size:
+                stack.extend(split(alternative, index))
+                break
+            index -= size
+    return output
+
+def iter_derivations(grammar, symbol="$S", start=0, stop=None):
+    # nth_derivation for start <= index < stop (default: all of them), so a
+    # variation space can be split into ranges and shared between workers
+    compiled = _compiled(grammar, symbol)
+    total = count_derivations(compiled, symbol)
+    if stop is None or stop > total:
+        stop = total
+    index = start
+    while index < stop:
+        yield nth_derivation(compiled, index, symbol)
+        index += 1
+
+GrammarOptimization = namedtuple("GrammarOptimization", ["folded", "dead", "unreachable", "dropped_alternatives",
+                                                         "sources", "fixed"])
+
+def optimize_grammar(compiled, start="$S", max_fold=4096):
+    # Copy of compiled without choices that are not really choices. A
+    # nonterminal with one usable alternative and only such nonterminals
+    # below it always derives the same terminals; the expansion (up to
+    # max_fold tokens) is precomputed and spliced into every alternative
+    # that uses it. Zero-weight alternatives and ones that can never finish
+    # are dropped, as are dead nonterminals and rules start cannot reach.
+    # Returns (optimized, GrammarOptimization): folded maps names to their
+    # terminals, dead and unreachable list names. Outputs are distributed as
+    # before (conditioned on finishing), but fewer random numbers are drawn,
+    # so a seeded derivation gives a different result than on the original.
+    # sources maps each alternative of optimized to the one in compiled it
+    # came from and fixed maps folded nonterminal ids to their alternative,
+    # which is what unfold_provenance needs.
+    cache = compiled.__dict__.setdefault("_optimized", {})
+    result = cache.get((start, max_fold))
+    if result is not None:
+        return result
+    n = compiled.num_nonterminals
+    symbols = compiled.symbols
+    start_id = compiled.symbol_ids.get(start)
+    if start_id is None or start_id >= n:
+        return compiled, GrammarOptimization({}, [], [], 0, array("i", range(len(compiled.alternatives))), {})
+    # min_lengths only counts alternatives that can be drawn, so a
+    # nonterminal is finite exactly when one of its weighted alternatives
+    # uses only finite nonterminals; those are the usable alternatives
+    finite = analyze_lengths(compiled).min_lengths
+    if finite[start_id] == math.inf:
+        raise GenerationError(f"Grammar cannot terminate: no alternative of '{start}' can finish.")
+
+    def reachable_from(bodies):
+        found, todo = set(), [start_id]
+        while todo:
+            x = todo.pop()
+            if x < n and x not in found:
+                found.add(x)
+                for body, _ in bodies[x]:
+                    todo.extend(body)
+        return found
+
+    original = [[(compiled.alternatives[k], compiled.weights[k])
+                 for k in range(compiled.alt_offsets[nt], compiled.alt_offsets[nt + 1])] for nt in range(n)]
+    usable_alternatives = [[k for k in _weighted_alternatives(compiled, nt)
+                            if all(x >= n or finite[x] != math.inf for x in compiled.alternatives[k])]
+                           for nt in range(n)]
+    usable = [[(compiled.alternatives[k], compiled.weights[k]) for k in alternatives]
+              for alternatives in usable_alternatives]
+    expansions = {}
+    too_long = set()
+    changed = True
+    while changed:
+        changed = False
+        for nt in range(n):
+            if nt in expansions or nt in too_long or len(usable[nt]) != 1:
+                continue
+            body = usable[nt][0][0]
+            if all(x >= n or x in expansions for x in body):
+                expansion = tuple(y for x in body for y in (expansions[x] if x < n else (x,)))
+                if len(expansion) > max_fold:
+                    too_long.add(nt)
+                else:
+                    expansions[nt] = expansion
+                changed = True
+
+    def splice(body):
+        return tuple(y for x in body for y in expansions.get(x, (x,)))
+
+    bodies = [[(expansions[nt], 1.0)] if nt in expansions else [(splice(body), weight) for body, weight in usable[nt]]
+              for nt in range(n)]
+    reachable = reachable_from(bodies)
+    dialect = compiled.dialect
+    grammar = Grammar(dialect)
+    grammar.terminal_type = compiled.terminal_type
+    for nt in sorted(reachable):
+        for body, weight in bodies[nt]:
+            grammar.add_rule(GrammarRule(symbols[nt], DIALECTS[dialect].join(symbols[x] for x in body), weight,
+                                         dialect=dialect))
+    grammar.divergent = find_divergent_nonterminals(grammar) if dialect == "dollar" else []
+    optimized = compile_grammar(grammar, start, compiled.terminal_type)
+    fixed = {nt: usable_alternatives[nt][0] for nt in expansions}
+    sources = array("i")
+    for nt in range(optimized.num_nonterminals):
+        nt = compiled.symbol_ids[optimized.symbols[nt]]
+        sources.extend([fixed[nt]] if nt in fixed else usable_alternatives[nt])
+
+    used = reachable_from(original)
+    report = GrammarOptimization(
+        folded={symbols[nt]: tuple(symbols[x] for x in expansions[nt]) for nt in sorted(expansions) if nt in used},
+        dead=[symbols[nt] for nt in range(n) if finite[nt] == math.inf and nt in used],
+        unreachable=[symbols[nt] for nt in range(n) if nt not in used],
+        dropped_alternatives=sum(len(original[nt]) - len(usable[nt]) for nt in used),
+        sources=sources, fixed=fixed)
+    result = cache[(start, max_fold)] = (optimized, report)
+    return result
+
+class LengthConditionedSampler:
+    # Draws derivations whose length is in `lengths` directly, with the same
+    # distribution as sampling freely and rejecting other lengths. Tables of
+    # P(X derives exactly l tokens) for every symbol and for every suffix of
+    # every alternative, l <= max(lengths), are built once; a draw then picks
+    # the total length, then an alternative per nonterminal and a length split
+    # per symbol, so its cost depends only on the output length.
+    def __init__(self, compiled, symbol, lengths):
+        lengths = sorted(set(lengths))
+        if not lengths:
+            raise GenerationError("No allowed output lengths given.")
+        self.compiled = compiled
+        self.limit = limit = lengths[-1]
+        dists = _length_tables(compiled, limit)
+        self.terminal_table = [1.0 if l == 1 else 0.0 for l in range(limit + 1)]
+        self.tables = [[dist.get(l, 0.0) for l in range(limit + 1)] for dist in dists]
+        self.alt_probs = []
+        for nt in range(compiled.num_nonterminals):
+            first, last = compiled.alt_offsets[nt], compiled.alt_offsets[nt + 1]
+            total = sum(compiled.weights[first:last])
+            self.alt_probs.extend(compiled.weights[k] / total for k in range(first, last))
+        self.suffixes = [self._suffix_tables(alternative) for alternative in compiled.alternatives]
+        self.start = tuple(compiled.encode(tokenize(symbol, compiled.dialect)))
+        self.start_suffixes = self._suffix_tables(self.start)
+        self.lengths = [l for l in lengths if l >= 0 and self.start_suffixes[0][l] > 0]
+        self.length_weights = [self.start_suffixes[0][l] for l in self.lengths]
+        # chance that a free derivation lands on an allowed length
+        self.acceptance = sum(self.length_weights)
+        if not self.lengths:
+            raise GenerationError(f"'{symbol}' cannot derive any of the allowed lengths "
+                                  f"({lengths[0]}..{lengths[-1]}).")
+
+    def table(self, symbol_id):
+        if symbol_id < self.compiled.num_nonterminals:
+            return self.tables[symbol_id]
+        return self.terminal_table
+
+    def _suffix_tables(self, symbols):
+        # suffix[j][l] = P(symbols[j:] derive exactly l tokens)
+        limit = self.limit
+        suffix = [None] * (len(symbols) + 1)
+        suffix[-1] = [1.0] + [0.0] * limit
+        for j in reversed(range(len(symbols))):
+            head, tail = self.table(symbols[j]), suffix[j + 1]
+            row = [0.0] * (limit + 1)
+            for l, p in enumerate(head):
+                if p:
+                    for m in range(limit + 1 - l):
+                        row[l + m] += p * tail[m]
+            suffix[j] = row
+        return suffix
+
+    def sample(self, rng=None):
+        rand = (rng or random).random
+        num_nonterminals = self.compiled.num_nonterminals
+        alt_offsets = self.compiled.alt_offsets
+        alternatives = self.compiled.alternatives
+        output = []
+        length = _pick(self.lengths, self.length_weights, rand())
+        # frames: (symbols, suffix tables, position, tokens still to produce)
+        stack = [(self.start, self.start_suffixes, 0, length)]
+        while stack:
+            symbols, suffix, j, remaining = stack.pop()
+            if j == len(symbols):
+                continue
+            symbol_id = symbols[j]
+            head, tail = self.table(symbol_id), suffix[j + 1]
+            splits = range(remaining + 1)
+            l = _pick(splits, [head[l] * tail[remaining - l] for l in splits], rand())
+            stack.append((symbols, suffix, j + 1, remaining - l))
+            if symbol_id >= num_nonterminals:
+                output.append(symbol_id)
+                continue
+            choices = range(alt_offsets[symbol_id], alt_offsets[symbol_id + 1])
+            k = _pick(choices, [self.alt_probs[k] * self.suffixes[k][0][l] for k in choices], rand())
+            stack.append((alternatives[k], self.suffixes[k], 0, l))
+        return output
+
+def conditioned_sampler(compiled, symbol, lengths):
+    # LengthConditionedSampler for compiled, built once per symbol and
+    # lengths; samplers keep no state between draws, so they can be shared
+    key = ("sampler", symbol, tuple(sorted(set(lengths))))
+    cache = _length_cache(compiled)
+    sampler = cache.get(key)
+    if sampler is None:
+        sampler = cache[key] = LengthConditionedSampler(compiled, symbol, lengths)
+    return sampler
+
+def _pick(items, weights, u):
+    # items[i] with probability proportional to weights[i]
+    target = u * sum(weights)
+    last = None
+    for item, weight in zip(items, weights):
+        if weight > 0:
+            last = item
+            target -= weight
+            if target < 0:
+                return item
+    return last
+
+GrammarCacheInfo = namedtuple("GrammarCacheInfo", ["hits", "misses", "size", "maxsize"])
+
+def normalize_grammar_text(text):
+    # whitespace-insensitive form of a grammar: the parser splits on
+    # whitespace anyway, so runs of spaces and blank lines do not matter
+    lines = (" ".join(line.split()) for line in text.split("\n"))
+    return "\n".join(line for line in lines if line)
+
+class GrammarCache:
+    # Bounded LRU cache of parsed and compiled grammars keyed by a hash of
+    # the normalized grammar text. Cached grammars are shared between callers
+    # and must not be modified.
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(text, start="$S", terminal_type=None, dialect="dollar"):
+        # spaces are symbols in "char" grammars, so only line ends are ignored
+        normalized = normalize_grammar_text(text) if dialect == "dollar" else text.strip()
+        digest = hashlib.sha256(normalized.encode()).hexdigest()
+        return digest, start, terminal_type, dialect
+
+    def get(self, text, start="$S", terminal_type=None, dialect="dollar"):
+        key = self.key(text, start, terminal_type, dialect)
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry
+        self.misses += 1
+        grammar = parse_grammar(text.split("\n"), dialect=dialect)
+        entry = (grammar, compile_grammar(grammar, start, terminal_type))
+        self.entries[key] = entry
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return entry
+
+    def info(self):
+        return GrammarCacheInfo(self.hits, self.misses, len(self.entries), self.maxsize)
+
+    def invalidate(self, text=None, dialect="dollar"):
+        # drop one grammar (all start symbols), or everything when text is None
+        if text is None:
+            self.entries.clear()
+            self.hits = self.misses = 0
+            return
+        digest = self.key(text, dialect=dialect)[0]
+        for key in [key for key in self.entries if key[0] == digest]:
+            del self.entries[key]
+
+grammar_cache = GrammarCache()
+
+def load_grammar(text, start="$S", terminal_type=None, dialect="dollar"):
+    # (Grammar, CompiledGrammar) for grammar text, parsed at most once
+    return grammar_cache.get(text, start, terminal_type, dialect)
+
+def grammar_cache_info():
+    return grammar_cache.info()
+
+def invalidate_grammar_cache(text=None, dialect="dollar"):
+    grammar_cache.invalidate(text, dialect)
+
+# Compiled grammar files: a pickled header describing the source file,
+# followed by the pickled (Grammar, CompiledGrammar) pair. Only load cache
+# files you wrote yourself; they are unpickled.
+GRAMMAR_FILE_FORMAT = 3
+GRAMMAR_FILE_SUFFIX = ".ggc"
+
+def _source_header(path, data, start, terminal_type, dialect="dollar"):
+    info = os.stat(path)
+    return {"format": GRAMMAR_FILE_FORMAT, "size": info.st_size, "mtime": info.st_mtime_ns,
+            "sha256": hashlib.sha256(data).hexdigest() if data is not None else None,
+            "start": start, "terminal_type": terminal_type, "dialect": dialect}
+
+def write_grammar_file(cache_path, header, grammar, compiled):
+    # write to a temporary file first so readers never see half a cache
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            pickle.dump(header, f, pickle.HIGHEST_PROTOCOL)
+            pickle.dump((grammar, compiled), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        # a read-only grammar directory just means no cache
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+    return True
+
+def read_grammar_file(cache_path):
+    # (header, f) with f positioned at the payload, or None without a usable cache
+    try:
+        f = open(cache_path, "rb")
+    except OSError:
+        return None
+    try:
+        header = pickle.load(f)
+    except Exception:
+        f.close()
+        return None
+    if not isinstance(header, dict) or header.get("format") != GRAMMAR_FILE_FORMAT:
+        f.close()
+        return None
+    return header, f
+
+def load_grammar_file(path, start="$S", cache_path=None, use_cache=True, terminal_type=None, dialect="dollar"):
+    # (Grammar, CompiledGrammar) for a grammar text file, read from the
+    # compiled cache next to it (path + ".ggc") when that is still fresh.
+    # Size and mtime matching the header is trusted; otherwise the source is
+    # hashed and only re-parsed when its content actually changed.
+    if cache_path is None:
+        cache_path = path + GRAMMAR_FILE_SUFFIX
+    cached = read_grammar_file(cache_path) if use_cache else None
+    data = None
+    if cached is not None:
+        header, f = cached
+        with f:
+            current = _source_header(path, None, start, terminal_type, dialect)
+            fresh = (header["size"] == current["size"] and header["mtime"] == current["mtime"]
+                     and header["dialect"] == dialect)
+            if not fresh:
+                with open(path, "rb") as source:
+                    data = source.read()
+                fresh = header["sha256"] == hashlib.sha256(data).hexdigest() and header["dialect"] == dialect
+            if fresh:
+                try:
+                    grammar, compiled = pickle.load(f)
+                except Exception:
+                    grammar = None
+                if grammar is not None:
+                    if header["start"] != start or header["terminal_type"] != terminal_type:
+                        compiled = compile_grammar(grammar, start, terminal_type)
+                    elif data is not None:
+                        # same content, new timestamp: refresh the header
+                        write_grammar_file(cache_path, _source_header(path, data, start, terminal_type, dialect),
+                                           grammar, compiled)
+                    return grammar, compiled
+    if data is None:
+        with open(path, "rb") as source:
+            data = source.read()
+    grammar = parse_grammar(data.decode().split("\n"), dialect=dialect)
+    compiled = compile_grammar(grammar, start, terminal_type)
+    if use_cache:
+        write_grammar_file(cache_path, _source_header(path, data, start, terminal_type, dialect), grammar, compiled)
+    return grammar, compiled
+
+def generate_from_symbol(grammar, symbol, rng=None):
+    options = grammar.index.get(symbol)
     if options:
-        return random.choice(options)
+        return options[grammar.choose_index(symbol, rng)]
     return symbol
 
-def generate_from_string(grammar, string):
+def generate_from_string(grammar, string, rng=None):
     output = ""
     i = 0
     while i < len(string):
@@ -61,18 +1370,586 @@ def generate_from_string(grammar, string):
             while j < len(string) and string[j] != " ":
                 j += 1
             nonterminal = string[i:j]
-            output += generate_from_symbol(grammar, nonterminal)
+            output += generate_from_symbol(grammar, nonterminal, rng)
             i = j
         else:
             output += string[i]
             i += 1
     return output
 
-def generate(grammar, symbol, depth):
-    if depth == 0:
-        return symbol
-    else:
-        return generate(grammar, generate_from_string(grammar, symbol), depth - 1)
+def tokenize(string, dialect="dollar"):
+    return list(string) if dialect == "char" else string.split()
+
+def expand_tokens(grammar, tokens, rng=None):
+    # One rewriting pass over a token list: every nonterminal is replaced by
+    # the tokens of a randomly chosen alternative, terminals are copied as is.
+    # Returns the new token list and the number of nonterminals expanded.
+    token_index = grammar.token_index
+    char = grammar.dialect == "char"
+    output = []
+    expanded = 0
+    for token in tokens:
+        if char or token[0] == "$":
+            options = token_index.get(token)
+            if options:
+                output.extend(options[grammar.choose_index(token, rng)])
+                expanded += 1
+                continue
+        output.append(token)
+    return output, expanded
+
+def derive_tokens(grammar, symbol, depth, rng=None, max_tokens=None, max_passes=None, max_time=None):
+    # Iterative driver: rewrite at most `depth` times, stopping at the first
+    # pass that finds nothing left to expand. Returns (tokens, passes) where
+    # passes counts the rewriting passes that actually expanded something.
+    # The max_* budgets raise BudgetExceededError instead (see GenerationBudget).
+    budget = GenerationBudget(max_tokens, max_passes, max_time)
+    char = grammar.dialect == "char"
+    tokens = tokenize(symbol, grammar.dialect)
+    passes = 0
+    while passes < depth:
+        expanded_tokens, expanded = expand_tokens(grammar, tokens, rng)
+        if not expanded:
+            break
+        tokens = expanded_tokens
+        passes += 1
+        budget.check(passes, len(tokens), lambda: any(grammar.has_rules(t) for t in tokens if char or t[0] == "$"))
+    if DEBUG:
+        print(f"derive_tokens: {passes} passes, {len(tokens)} tokens")
+    return tokens, passes
+
+def generate_tokens(grammar, symbol, depth, rng=None, max_tokens=None, max_passes=None, max_time=None):
+    return derive_tokens(grammar, symbol, depth, rng, max_tokens, max_passes, max_time)[0]
+
+def generate(grammar, symbol, depth, rng=None, max_tokens=None, max_passes=None, max_time=None):
+    # rng: any object with a random() method, e.g. random.Random(seed);
+    # defaults to the module-level random stream
+    return DIALECTS[grammar.dialect].join(generate_tokens(grammar, symbol, depth, rng, max_tokens, max_passes, max_time))
+
+def expand_ids(compiled, ids, rng=None):
+    # expand_tokens over symbol ids of a CompiledGrammar
+    num_nonterminals = compiled.num_nonterminals
+    alt_offsets = compiled.alt_offsets
+    alias_prob = compiled.alias_prob
+    alias_index = compiled.alias_index
+    alternatives = compiled.alternatives
+    rand = (rng or random).random
+    output = []
+    expanded = 0
+    for symbol_id in ids:
+        if symbol_id < num_nonterminals:
+            # inlined CompiledGrammar.choose()
+            first = alt_offsets[symbol_id]
+            u = rand() * (alt_offsets[symbol_id + 1] - first)
+            i = int(u)
+            if u - i >= alias_prob[first + i]:
+                i = alias_index[first + i]
+            output.extend(alternatives[first + i])
+            expanded += 1
+        else:
+            output.append(symbol_id)
+    return output, expanded
+
+def derive_ids(compiled, symbol, depth, rng=None, max_tokens=None, max_passes=None, max_time=None):
+    # derive_tokens over a CompiledGrammar; returns (ids, passes)
+    budget = GenerationBudget(max_tokens, max_passes, max_time)
+    num_nonterminals = compiled.num_nonterminals
+    ids = compiled.encode(tokenize(symbol, compiled.dialect))
+    passes = 0
+    while passes < depth:
+        expanded_ids, expanded = expand_ids(compiled, ids, rng)
+        if not expanded:
+            break
+        ids = expanded_ids
+        passes += 1
+        budget.check(passes, len(ids), lambda: any(s < num_nonterminals for s in ids))
+    return ids, passes
+
+class Provenance:
+    # Which rules produced each token of a derivation, as parent pointers.
+    # Expansion j used alternative alternatives[j] and happened inside
+    # expansion parents[j] (-1 for the start string); token i was written
+    # by expansion tokens[i]. Parents always come before their children.
+    def __init__(self, compiled, alternatives, parents, tokens):
+        self.compiled = compiled
+        self.alternatives = alternatives
+        self.parents = parents
+        self.tokens = tokens
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def nonterminal(self, k):
+        # name of the nonterminal alternative k belongs to
+        return self.compiled.symbols[bisect.bisect_right(self.compiled.alt_offsets, k) - 1]
+
+    def rule(self, k):
+        return f"{self.nonterminal(k)} -> {' '.join(self.compiled.decode(self.compiled.alternatives[k]))}"
+
+    def chain(self, i):
+        # alternative indices that led to token i, outermost first
+        chain = []
+        node = self.tokens[i]
+        while node >= 0:
+            chain.append(self.alternatives[node])
+            node = self.parents[node]
+        chain.reverse()
+        return chain
+
+    def rules(self, i):
+        return [self.rule(k) for k in self.chain(i)]
+
+    def tokens_from(self, symbol):
+        # indices of the tokens with an expansion of symbol in their chain
+        inside = array("b", [0]) * len(self.alternatives)
+        for node, (k, parent) in enumerate(zip(self.alternatives, self.parents)):
+            inside[node] = self.nonterminal(k) == symbol or (parent >= 0 and inside[parent])
+        return [i for i, node in enumerate(self.tokens) if node >= 0 and inside[node]]
+
+def derive_ids_traced(compiled, symbol, depth, rng=None, max_tokens=None, max_passes=None, max_time=None):
+    # derive_ids that also records a Provenance: (ids, passes, provenance).
+    # It draws the same random numbers, so the ids match derive_ids exactly;
+    # derive_ids itself does no bookkeeping.
+    budget = GenerationBudget(max_tokens, max_passes, max_time)
+    num_nonterminals = compiled.num_nonterminals
+    alternatives = compiled.alternatives
+    rand = (rng or random).random
+    node_alternatives = array("i")
+    node_parents = array("i")
+    ids = compiled.encode(tokenize(symbol, compiled.dialect))
+    owners = [-1] * len(ids)
+    passes = 0
+    while passes < depth:
+        output = []
+        output_owners = []
+        first_node = len(node_alternatives)
+        for symbol_id, owner in zip(ids, owners):
+            if symbol_id < num_nonterminals:
+                k = compiled.choose(symbol_id, rand())
+                node = len(node_alternatives)
+                node_alternatives.append(k)
+                node_parents.append(owner)
+                output.extend(alternatives[k])
+                output_owners.extend([node] * len(alternatives[k]))
+            else:
+                output.append(symbol_id)
+                output_owners.append(owner)
+        if len(node_alternatives) == first_node:
+            break
+        ids, owners = output, output_owners
+        passes += 1
+        budget.check(passes, len(ids), lambda: any(s < num_nonterminals for s in ids))
+    return ids, passes, Provenance(compiled, node_alternatives, node_parents, array("i", owners))
+
+def unfold_provenance(compiled, optimization, provenance, symbol):
+    # Provenance of a derivation traced on the grammar optimize_grammar made
+    # from compiled (optimization is its report), in terms of compiled's own
+    # rules. The derivation is replayed on compiled: folded nonterminals take
+    # their only alternative, every other nonterminal the next recorded
+    # choice. Folding only removes whole single-choice subtrees, so the other
+    # nonterminals come up in the same order in both grammars.
+    num_nonterminals = compiled.num_nonterminals
+    alternatives = compiled.alternatives
+    fixed = optimization.fixed
+    choices = [optimization.sources[k] for k in provenance.alternatives]
+    next_choice = 0
+    node_alternatives = array("i")
+    node_parents = array("i")
+    ids = compiled.encode(tokenize(symbol, compiled.dialect))
+    owners = [-1] * len(ids)
+    while True:
+        output = []
+        output_owners = []
+        first_node = len(node_alternatives)
+        for symbol_id, owner in zip(ids, owners):
+            k = None
+            if symbol_id < num_nonterminals:
+                k = fixed.get(symbol_id)
+                if k is None and next_choice < len(choices):
+                    k = choices[next_choice]
+                    next_choice += 1
+            if k is None:
+                output.append(symbol_id)
+                output_owners.append(owner)
+                continue
+            node = len(node_alternatives)
+            node_alternatives.append(k)
+            node_parents.append(owner)
+            output.extend(alternatives[k])
+            output_owners.extend([node] * len(alternatives[k]))
+        if len(node_alternatives) == first_node:
+            break
+        ids, owners = output, output_owners
+    return Provenance(compiled, node_alternatives, node_parents, array("i", owners))
+
+def generate_compiled(compiled, symbol, depth, rng=None, max_tokens=None, max_passes=None, max_time=None):
+    ids = derive_ids(compiled, symbol, depth, rng, max_tokens, max_passes, max_time)[0]
+    return DIALECTS[compiled.dialect].join(compiled.decode(ids))
+
+def generate_values(compiled, symbol, depth, rng=None, max_tokens=None, max_passes=None, max_time=None):
+    # like generate_compiled, but the output is an array of the terminals'
+    # numeric values (see compile_grammar's terminal_type; a list of
+    # (pitch, duration, velocity) tuples for "note")
+    ids = derive_ids(compiled, symbol, depth, rng, max_tokens, max_passes, max_time)[0]
+    if isinstance(compiled.values, list):
+        return compiled.decode_values(ids)
+    return array(compiled.values.typecode, compiled.decode_values(ids))
+
+def iter_ids(compiled, symbol, rng=None, max_depth=None):
+    # Leftmost derivation with an explicit stack of (alternative, position)
+    # frames, yielding terminal ids as soon as they are reached. A frame is
+    # dropped before its last symbol is expanded, so right recursion like
+    # "$S -> 60 $S" streams in constant memory; in general memory is bounded
+    # by the derivation depth, which max_depth can cap.
+    started = time.monotonic()
+    rand = (rng or random).random
+    num_nonterminals = compiled.num_nonterminals
+    alternatives = compiled.alternatives
+    stack = [(tuple(compiled.encode(tokenize(symbol, compiled.dialect))), 0)]
+    produced = 0
+    while stack:
+        symbols, position = stack.pop()
+        if position == len(symbols):
+            continue
+        symbol_id = symbols[position]
+        if position + 1 < len(symbols):
+            stack.append((symbols, position + 1))
+        if symbol_id < num_nonterminals:
+            stack.append((alternatives[compiled.choose(symbol_id, rand())], 0))
+            if max_depth is not None and len(stack) > max_depth:
+                raise BudgetExceededError("depth", max_depth, None, produced, time.monotonic() - started)
+        else:
+            produced += 1
+            yield symbol_id
+
+def iter_generate(grammar, start="$S", rng=None, max_depth=None):
+    # Terminal tokens of one derivation from start, one at a time. Follows
+    # the same distribution as generate() (but not the same random draws).
+    compiled = grammar if isinstance(grammar, CompiledGrammar) else compile_grammar(grammar, start)
+    symbols = compiled.symbols
+    for symbol_id in iter_ids(compiled, start, rng, max_depth):
+        yield symbols[symbol_id]
+
+class Constraint:
+    # A rule on the values of a derivation, checked as each terminal is
+    # produced: allows(values, value) tells whether value may follow the
+    # values produced so far. rejections counts the values it turned down.
+    name = "constraint"
+
+    def __init__(self):
+        self.rejections = 0
+
+    def allows(self, values, value):
+        return True
+
+    def __repr__(self):
+        return f"<{self.name}: {self.rejections} rejections>"
+
+class MaxInterval(Constraint):
+    # consecutive values differ by at most max_interval
+    name = "max_interval"
+
+    def __init__(self, max_interval):
+        super().__init__()
+        self.max_interval = max_interval
+
+    def allows(self, values, value):
+        return not values or abs(value - values[-1]) <= self.max_interval
+
+class ValueRange(Constraint):
+    # every value lies in low..high
+    name = "range"
+
+    def __init__(self, low, high):
+        super().__init__()
+        self.low = low
+        self.high = high
+
+    def allows(self, values, value):
+        return self.low <= value <= self.high
+
+class NoRepeat(Constraint):
+    # no value count times in a row
+    name = "no_repeat"
+
+    def __init__(self, count=3):
+        super().__init__()
+        self.count = count
+
+    def allows(self, values, value):
+        n = self.count - 1
+        return len(values) < n or any(v != value for v in values[len(values) - n:])
+
+def derive_constrained(compiled, symbol, constraints, rng=None, max_backtracks=1000, max_tokens=None,
+                       max_time=None):
+    # Leftmost derivation (as in iter_ids) whose terminals must pass every
+    # constraint. Each expansion is a choice point; when a value is turned
+    # down, the derivation goes back to the latest choice point that still
+    # has untried alternatives, draws one of those by weight and carries on
+    # from there, so a bad choice costs a re-sample rather than a new list.
+    # Returns (ids, backtracks). Raises BudgetExceededError("backtracks")
+    # after max_backtracks and GenerationError once every option is tried.
+    budget = GenerationBudget(max_tokens, None, max_time)
+    rand = (rng or random).random
+    num_nonterminals = compiled.num_nonterminals
+    alternatives = compiled.alternatives
+    weights = compiled.weights
+    lookup = compiled.values if compiled.values is not None else compiled.symbols
+    output = []
+    values = []
+    stack = [(tuple(compiled.encode(tokenize(symbol, compiled.dialect))), 0)]
+    # (output length, stack after the nonterminal, nonterminal, tried alternatives)
+    choices = []
+    backtracks = 0
+    while stack:
+        symbols, position = stack.pop()
+        if position == len(symbols):
+            continue
+        symbol_id = symbols[position]
+        if position + 1 < len(symbols):
+            stack.append((symbols, position + 1))
+        if symbol_id < num_nonterminals:
+            k = compiled.choose(symbol_id, rand())
+            choices.append((len(output), list(stack), symbol_id, {k}))
+            stack.append((alternatives[k], 0))
+            continue
+        value = lookup[symbol_id]
+        rejected = False
+        for constraint in constraints:
+            if not constraint.allows(values, value):
+                constraint.rejections += 1
+                rejected = True
+                break
+        if not rejected:
+            output.append(symbol_id)
+            values.append(value)
+            budget.check(None, len(output), None)
+            continue
+        backtracks += 1
+        if backtracks > max_backtracks:
+            raise BudgetExceededError("backtracks", max_backtracks, None, len(output),
+                                      time.monotonic() - budget.started)
+        while choices:
+            length, saved, nt, tried = choices[-1]
+            untried = [k for k in range(compiled.alt_offsets[nt], compiled.alt_offsets[nt + 1])
+                       if k not in tried and weights[k] > 0]
+            if untried:
+                k = _pick(untried, [weights[k] for k in untried], rand())
+                tried.add(k)
+                del output[length:]
+                del values[length:]
+                # saved stays as it is in case this alternative fails too
+                stack = saved + [(alternatives[k], 0)]
+                break
+            choices.pop()
+        else:
+            raise GenerationError(f"No derivation of '{symbol}' satisfies "
+                                  f"{', '.join(c.name for c in constraints)}.")
+    return output, backtracks
+
+def choose_bulk(compiled, nonterminals, rng=None):
+    # Alternative indices for a whole list of nonterminal ids at once. With
+    # NumPy, rng may be a numpy Generator; the uniforms for all nonterminals
+    # are drawn in one call and the alias lookup is vectorized.
+    if np is None:
+        rand = (rng or random).random
+        return [compiled.choose(nt, rand()) for nt in nonterminals]
+    return _choose_bulk_numpy(compiled, nonterminals, rng).tolist()
+
+def _choose_bulk_numpy(compiled, nonterminals, rng):
+    if not isinstance(rng, np.random.Generator):
+        rng = np.random.default_rng((rng or random).getrandbits(64))
+    alt_offsets, alias_prob, alias_index = compiled.numpy_tables()
+    nts = np.asarray(nonterminals, dtype=np.int64)
+    first = alt_offsets[nts]
+    u = rng.random(len(nts)) * (alt_offsets[nts + 1] - first)
+    column = u.astype(np.int64)
+    chosen = first + column
+    use_alias = (u - column) >= alias_prob[chosen]
+    chosen[use_alias] = first[use_alias] + alias_index[chosen[use_alias]]
+    return chosen
+
+def derive_batch(compiled, symbol, n, depth, rng=None, max_tokens=None, max_passes=None, max_time=None,
+                 drop_over_budget=False):
+    # n independent derivations advanced level by level: each pass gathers
+    # the nonterminals of every unfinished sequence and draws all their
+    # alternatives in one go. rng is either one stream shared by the batch
+    # (bulk sampling, NumPy when available) or a list of n streams, in which
+    # case item i is exactly derive_ids(compiled, symbol, depth, rng[i]).
+    # Token and pass budgets apply per item; with drop_over_budget an item
+    # that runs out comes back as None instead of aborting the batch.
+    budget = GenerationBudget(max_tokens, max_passes, max_time)
+    start = compiled.encode(tokenize(symbol, compiled.dialect))
+    num_nonterminals = compiled.num_nonterminals
+    alternatives = compiled.alternatives
+    sequences = [list(start) for _ in range(n)]
+    active = list(range(n))
+    per_item = isinstance(rng, (list, tuple))
+    if not per_item and np is not None and not isinstance(rng, np.random.Generator):
+        rng = np.random.default_rng((rng or random).getrandbits(64))
+    passes = 0
+    while active and passes < depth:
+        pending = []
+        nonterminals = []
+        for i in active:
+            nts = [s for s in sequences[i] if s < num_nonterminals]
+            if nts:
+                pending.append((i, len(nts)))
+                nonterminals.extend(nts)
+        if not pending:
+            break
+        if per_item:
+            choices = []
+            position = 0
+            for i, count in pending:
+                rand = rng[i].random
+                choices.extend(compiled.choose(nt, rand()) for nt in nonterminals[position:position + count])
+                position += count
+        else:
+            choices = choose_bulk(compiled, nonterminals, rng)
+        position = 0
+        for i, count in pending:
+            chosen = iter(choices[position:position + count])
+            position += count
+            output = []
+            for s in sequences[i]:
+                if s < num_nonterminals:
+                    output.extend(alternatives[next(chosen)])
+                else:
+                    output.append(s)
+            sequences[i] = output
+        active = [i for i, _ in pending]
+        passes += 1
+        for i in list(active):
+            item = sequences[i]
+            exceeded = budget.exceeded(passes, len(item), lambda: any(s < num_nonterminals for s in item))
+            if exceeded is None:
+                continue
+            if exceeded == "time" or not drop_over_budget:
+                raise budget.error(exceeded, passes, len(item))
+            sequences[i] = None
+            active.remove(i)
+    return sequences, passes
+
+def generate_batch(grammar, symbol, n, depth, rng=None, max_tokens=None, max_passes=None, max_time=None):
+    # n strings as generate() would return them; accepts a Grammar or a CompiledGrammar
+    compiled = grammar if isinstance(grammar, CompiledGrammar) else compile_grammar(grammar, symbol)
+    sequences, _ = derive_batch(compiled, symbol, n, depth, rng, max_tokens, max_passes, max_time)
+    return [DIALECTS[compiled.dialect].join(compiled.decode(ids)) for ids in sequences]
+
+class LSystem:
+    # Parallel rewriting: on every iteration each symbol that has rules is
+    # replaced at once (by weight when it has several alternatives) and the
+    # others are copied. Rules use the grammar syntax, but any token can be
+    # rewritten and left recursion ("A -> A B") is allowed; the axiom is a
+    # whitespace-separated string. mapping turns symbols into notes:
+    # symbol -> (pitch, duration, velocity) or "60/0.5/100"; symbols without
+    # a mapping produce no note.
+    def __init__(self, rules, axiom, mapping=None):
+        if not isinstance(rules, Grammar):
+            rules = parse_grammar(rules.split("\n"), lsystem=True)
+        self.grammar = rules
+        self.axiom = axiom
+        self.compiled = compile_grammar(rules, axiom, lsystem=True)
+        self.axiom_ids = self.compiled.encode(tokenize(axiom))
+        self.notes = [None] * len(self.compiled.symbols)
+        for symbol, note in (mapping or {}).items():
+            symbol_id = self.compiled.symbol_ids.get(symbol)
+            if symbol_id is not None:
+                self.notes[symbol_id] = _note(note) if isinstance(note, str) else tuple(note) + NOTE_DEFAULTS[len(note):]
+
+    def _numpy_tables(self):
+        # every alternative, then one identity "production" per terminal:
+        # where its symbols start in table, and how many there are
+        compiled = self.compiled
+        rhs_offsets = np.frombuffer(compiled.rhs_offsets, dtype=np.int32).astype(np.int64)
+        terminals = np.arange(compiled.num_nonterminals, len(compiled.symbols), dtype=np.int64)
+        table = np.concatenate([np.frombuffer(compiled.rhs, dtype=np.int32).astype(np.int64), terminals])
+        starts = np.concatenate([rhs_offsets[:-1], len(compiled.rhs) + np.arange(len(terminals))])
+        lengths = np.concatenate([np.diff(rhs_offsets), np.ones(len(terminals), dtype=np.int64)])
+        return table, starts, lengths
+
+    def rewrite(self, iterations, rng=None, max_tokens=None, max_time=None):
+        # symbol ids after iterations rewrites (fewer when nothing is left to
+        # rewrite), as a NumPy array when NumPy is available, else array("i");
+        # a level larger than max_tokens is never built
+        budget = GenerationBudget(max_tokens, None, max_time)
+        compiled = self.compiled
+        n = compiled.num_nonterminals
+        if np is None:
+            rand = (rng or random).random
+            alternatives = compiled.alternatives
+            current = array("i", self.axiom_ids)
+            for iteration in range(iterations):
+                if not any(x < n for x in current):
+                    break
+                choices = [compiled.choose(x, rand()) if x < n else -1 for x in current]
+                tokens = sum(len(alternatives[k]) if k >= 0 else 1 for k in choices)
+                budget.check(iteration, tokens, lambda: True)
+                rewritten = array("i")
+                for x, k in zip(current, choices):
+                    if k >= 0:
+                        rewritten.extend(alternatives[k])
+                    else:
+                        rewritten.append(x)
+                current = rewritten
+            return current
+        if not isinstance(rng, np.random.Generator):
+            rng = np.random.default_rng((rng or random).getrandbits(64))
+        table, starts, lengths = self._numpy_tables()
+        num_alternatives = len(compiled.alternatives)
+        current = np.asarray(self.axiom_ids, dtype=np.int64)
+        for iteration in range(iterations):
+            rewritable = current < n
+            if not rewritable.any():
+                break
+            production = current - n + num_alternatives
+            production[rewritable] = _choose_bulk_numpy(compiled, current[rewritable], rng)
+            sizes = lengths[production]
+            tokens = int(sizes.sum())
+            budget.check(iteration, tokens, lambda: True)
+            # position j of the next level reads table[start of its production + offset within it]
+            shift = np.repeat(starts[production] - (np.cumsum(sizes) - sizes), sizes)
+            current = table[shift + np.arange(tokens)]
+        return current
+
+    def iter_ids(self, iterations, rng=None):
+        # The same rewriting depth first: each symbol is taken through its
+        # remaining iterations before the next one is touched, so memory
+        # stays proportional to iterations however long the output gets.
+        compiled = self.compiled
+        n = compiled.num_nonterminals
+        alternatives = compiled.alternatives
+        rand = (rng or random).random
+        stack = [(x, iterations) for x in reversed(self.axiom_ids)]
+        while stack:
+            x, left = stack.pop()
+            if x >= n or left == 0:
+                yield x
+                continue
+            stack.extend((y, left - 1) for y in reversed(alternatives[compiled.choose(x, rand())]))
+
+    def generate(self, iterations, rng=None, max_tokens=None, max_time=None):
+        symbols = self.compiled.symbols
+        return " ".join(symbols[x] for x in self.rewrite(iterations, rng, max_tokens, max_time).tolist())
+
+    def note_lists(self, iterations, rng=None, max_tokens=None, max_time=None):
+        # (pitch_list, duration_list, velocity_list) of the mapped symbols
+        ids = self.rewrite(iterations, rng, max_tokens, max_time)
+        if np is not None:
+            mapped = np.array([note is not None for note in self.notes])
+            ids = ids[mapped[ids]]
+            columns = [np.array([note[j] if note else 0 for note in self.notes])[ids].tolist() for j in range(3)]
+            return columns[0], columns[1], columns[2]
+        notes = [self.notes[x] for x in ids if self.notes[x] is not None]
+        return [note[0] for note in notes], [note[1] for note in notes], [note[2] for note in notes]
+
+    def iter_notes(self, iterations, rng=None):
+        # (pitch, duration, velocity) tuples, streamed through iter_ids
+        notes = self.notes
+        for x in self.iter_ids(iterations, rng):
+            if notes[x] is not None:
+                yield notes[x]
 
 if __name__ == "__main__":
     if len(sys.argv) != 3:
@@ -82,8 +1959,7 @@ if __name__ == "__main__":
     grammar_file = sys.argv[1]
     depth = int(sys.argv[2])
 
-    with open(grammar_file) as f:
-        grammar = parse_grammar(f)
-        print(grammar)
-        print(generate(grammar, "$S", depth))
+    grammar, compiled = load_grammar_file(grammar_file)
+    print(grammar)
+    print(generate_compiled(compiled, "$S", depth))
 
@@ -0,0 +1,242 @@
+#infers gengramparser2 grammars from note sequences with the sequitur algorithm
+#(nevill-manning & witten): repeated digrams become rules, in linear time
+
+import os
+import sys
+
+from midi_parser import MIDIParser
+
+
+class Symbol:
+    # One symbol in a rule body, a doubly linked list closed by the rule's
+    # guard. rule is set for nonterminals, value for terminals; the guard
+    # of a rule has guard_of set instead.
+    __slots__ = ("value", "rule", "guard_of", "prev", "next")
+
+    def __init__(self, value=None, rule=None, guard_of=None):
+        self.value = value
+        self.rule = rule
+        self.guard_of = guard_of
+        self.prev = self.next = None
+        if rule is not None:
+            rule.refs += 1
+
+    def key(self):
+        return self.rule if self.rule is not None else ("t", self.value)
+
+
+class Rule:
+    def __init__(self):
+        self.refs = 0
+        self.guard = Symbol(guard_of=self)
+        self.guard.prev = self.guard.next = self.guard
+
+    def first(self):
+        return self.guard.next
+
+    def last(self):
+        return self.guard.prev
+
+    def symbols(self):
+        symbol = self.guard.next
+        while symbol is not self.guard:
+            yield symbol
+            symbol = symbol.next
+
+
+class Sequitur:
+    # Builds the grammar one value at a time while keeping two invariants:
+    # no digram occurs twice (digram uniqueness) and every rule is used at
+    # least twice (rule utility). Values can be any hashable tokens.
+    def __init__(self):
+        self.start = Rule()
+        self.digrams = {}
+
+    def push(self, value):
+        self._insert_after(self.start.last(), Symbol(value))
+        if self.start.first() is not self.start.last():
+            self._check(self.start.last().prev)
+
+    def extend(self, values):
+        for value in values:
+            self.push(value)
+
+    def _digram(self, symbol):
+        return symbol.key(), symbol.next.key()
+
+    def _forget_digram(self, symbol):
+        if symbol.guard_of is not None or symbol.next.guard_of is not None:
+            return
+        digram = self._digram(symbol)
+        if self.digrams.get(digram) is symbol:
+            del self.digrams[digram]
+
+    def _join(self, left, right):
+        if left.next is not None:
+            self._forget_digram(left)
+            # in runs like "a a a" the overlapping digram is not indexed, so
+            # index it again once the one that hid it goes away
+            if (right.prev is not None and right.next is not None and right.guard_of is None
+                    and right.key() == right.prev.key() == right.next.key()):
+                self.digrams[self._digram(right)] = right
+            if (left.prev is not None and left.next is not None and left.guard_of is None
+                    and left.key() == left.prev.key() == left.next.key()):
+                self.digrams[self._digram(left.prev)] = left.prev
+        left.next = right
+        right.prev = left
+
+    def _insert_after(self, left, symbol):
+        self._join(symbol, left.next)
+        self._join(left, symbol)
+
+    def _delete(self, symbol):
+        self._join(symbol.prev, symbol.next)
+        self._forget_digram(symbol)
+        if symbol.rule is not None:
+            symbol.rule.refs -= 1
+
+    def _check(self, symbol):
+        # index the digram starting at symbol; on a repeat, make it a rule
+        if symbol.guard_of is not None or symbol.next.guard_of is not None:
+            return False
+        digram = self._digram(symbol)
+        match = self.digrams.get(digram)
+        if match is None:
+            self.digrams[digram] = symbol
+            return False
+        if match.next is not symbol:  # overlapping, as in "a a a"
+            self._match(symbol, match)
+        return True
+
+    def _copy(self, symbol):
+        return Symbol(symbol.value, symbol.rule)
+
+    def _substitute(self, symbol, rule):
+        # replace symbol and the one after it by a reference to rule
+        prev = symbol.prev
+        self._delete(prev.next)
+        self._delete(prev.next)
+        self._insert_after(prev, Symbol(rule=rule))
+        if not self._check(prev):
+            self._check(prev.next)
+
+    def _match(self, new, match):
+        if match.prev.guard_of is not None and match.next.next.guard_of is not None:
+            # the earlier occurrence is a whole rule already
+            rule = match.prev.guard_of
+            self._substitute(new, rule)
+        else:
+            rule = Rule()
+            self._insert_after(rule.last(), self._copy(new))
+            self._insert_after(rule.last(), self._copy(new.next))
+            self._substitute(match, rule)
+            self._substitute(new, rule)
+            self.digrams[self._digram(rule.first())] = rule.first()
+        first = rule.first()
+        if first.rule is not None and first.rule.refs == 1:
+            self._expand(first)
+
+    def _expand(self, symbol):
+        # inline a rule that is now used only once
+        left, right = symbol.prev, symbol.next
+        rule = symbol.rule
+        first, last = rule.first(), rule.last()
+        self._forget_digram(symbol)
+        rule.refs -= 1
+        self._join(left, first)
+        self._join(last, right)
+        self.digrams[self._digram(last)] = last
+
+    def rules(self):
+        # [(rule, body)] with the start rule first and the others in order of
+        # first use; body items are values or Rule objects
+        found = [self.start]
+        seen = {self.start}
+        result = []
+        i = 0
+        while i < len(found):
+            body = []
+            for symbol in found[i].symbols():
+                if symbol.rule is not None:
+                    if symbol.rule not in seen:
+                        seen.add(symbol.rule)
+                        found.append(symbol.rule)
+                    body.append(symbol.rule)
+                else:
+                    body.append(symbol.value)
+            result.append((found[i], body))
+            i += 1
+        return result
+
+
+def rule_names():
+    # $A .. $Z, $AA, $AB, ... skipping $S, which is the start rule
+    length = 1
+    while True:
+        for i in range(26 ** length):
+            name = ""
+            for _ in range(length):
+                i, digit = divmod(i, 26)
+                name = chr(ord("A") + digit) + name
+            if name != "S":
+                yield "$" + name
+        length += 1
+
+
+def format_value(value, parameter):
+    if parameter == "note":
+        pitch, duration, velocity = value
+        return f"{pitch}/{duration:g}/{velocity}"
+    if parameter == "duration":
+        return f"{value:g}"
+    return str(value)
+
+
+def induce_grammar(values, parameter=None):
+    # gengramparser2 grammar text that derives exactly values from $S.
+    # With a parameter ("pitch", "duration", "velocity" or "note") values
+    # are formatted for it and the grammar declares %type <parameter>.
+    sequitur = Sequitur()
+    sequitur.extend(values)
+    rules = sequitur.rules()
+    names = dict(zip((rule for rule, _ in rules[1:]), rule_names()))
+    names[sequitur.start] = "$S"
+    lines = [f"%type {parameter}"] if parameter else []
+    for rule, body in rules:
+        tokens = [names[item] if isinstance(item, Rule) else format_value(item, parameter) if parameter else str(item)
+                  for item in body]
+        lines.append(f"{names[rule]} -> {' '.join(tokens)}")
+    return "\n".join(lines) + "\n"
+
+
+def grammar_from_midi(path, parameter="pitch", grid=0.125):
+    notes = MIDIParser(path).get_notes(grid)
+    if not notes:
+        raise ValueError(f"No notes in {path}.")
+    if parameter == "note":
+        values = notes
+    else:
+        values = [note[("pitch", "duration", "velocity").index(parameter)] for note in notes]
+    return induce_grammar(values, parameter)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (3, 4):
+        print("Usage: python3 grammar_induction.py <midi_file_or_dir> <pitch|duration|velocity|note> [out_dir]")
+        sys.exit(1)
+
+    source, parameter = sys.argv[1], sys.argv[2]
+    if os.path.isdir(source):
+        paths = sorted(os.path.join(source, name) for name in os.listdir(source)
+                       if name.lower().endswith((".mid", ".midi")))
+    else:
+        paths = [source]
+    out_dir = sys.argv[3] if len(sys.argv) == 4 else None
+    for path in paths:
+        text = grammar_from_midi(path, parameter)
+        if out_dir is None:
+            print(f"# {path}\n{text}")
+            continue
+        name = os.path.splitext(os.path.basename(path))[0]
+        with open(os.path.join(out_dir, f"{name}.{parameter}.txt"), "w") as f:
+            f.write(text)
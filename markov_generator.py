@@ -0,0 +1,194 @@
+#order-k markov chains over pitch, duration and velocity, learned from midi files
+#MarkovListGenerator can stand in for savellysKone3.ListGenerator in a Song
+
+import os
+import pickle
+import random
+import sys
+from array import array
+from bisect import bisect_right
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+from midi_parser import MIDIParser
+
+PARAMETERS = ("pitch", "duration", "velocity", "note")
+MODEL_FORMAT = 1
+
+
+def read_notes(path, grid=0.125):
+    # (pitch, duration, velocity) of every note in a midi file in onset order,
+    # durations in beats rounded to grid; the drum channel is skipped
+    return MIDIParser(path).get_notes(grid)
+
+
+def count_transitions(path, order, grid=0.125):
+    # parameter -> {context: Counter(next value)} for contexts of every length
+    # up to order, so sampling can back off to shorter contexts
+    notes = read_notes(path, grid)
+    sequences = {"pitch": [note[0] for note in notes],
+                 "duration": [note[1] for note in notes],
+                 "velocity": [note[2] for note in notes],
+                 "note": notes}
+    counts = {}
+    for parameter, sequence in sequences.items():
+        table = counts[parameter] = {}
+        for i, value in enumerate(sequence):
+            for k in range(min(order, i) + 1):
+                table.setdefault(tuple(sequence[i - k:i]), Counter())[value] += 1
+    return counts
+
+
+def midi_files(paths):
+    # midi files among paths, directories searched recursively
+    if isinstance(paths, str):
+        paths = [paths]
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                found.extend(os.path.join(root, name) for name in names
+                             if name.lower().endswith((".mid", ".midi")))
+        else:
+            found.append(path)
+    return sorted(found)
+
+
+class MarkovTable:
+    # Transition table of one parameter. Values are stored once in values and
+    # referred to by index; contexts maps a tuple of value indices (0 to order
+    # long) to a row, and row r's successors are next_ids[offsets[r]:offsets[r+1]]
+    # with running counts in cumulative, so a draw is one bisect.
+    def __init__(self, order, counts):
+        self.order = order
+        self.values = sorted({value for successors in counts.values() for value in successors})
+        value_ids = {value: i for i, value in enumerate(self.values)}
+        self.contexts = {}
+        self.offsets = array("i", [0])
+        self.next_ids = array("i")
+        self.cumulative = array("q")
+        for context in sorted(counts, key=lambda c: (len(c), c)):
+            self.contexts[tuple(value_ids[value] for value in context)] = len(self.offsets) - 1
+            total = 0
+            for value, count in sorted(counts[context].items()):
+                total += count
+                self.next_ids.append(value_ids[value])
+                self.cumulative.append(total)
+            self.offsets.append(len(self.next_ids))
+
+    def sample(self, history, rng):
+        # next value index after history (a list of value indices), using the
+        # longest context seen in training
+        for k in range(min(self.order, len(history)), -1, -1):
+            row = self.contexts.get(tuple(history[len(history) - k:]))
+            if row is not None:
+                break
+        lo, hi = self.offsets[row], self.offsets[row + 1]
+        target = rng.random() * self.cumulative[hi - 1]
+        return self.next_ids[bisect_right(self.cumulative, target, lo, hi - 1)]
+
+
+class MarkovModel:
+    def __init__(self, tables, order, grid):
+        self.tables = tables
+        self.order = order
+        self.grid = grid
+
+    @classmethod
+    def from_counts(cls, counts, order, grid=0.125):
+        tables = {parameter: MarkovTable(order, table) for parameter, table in counts.items() if table}
+        if not tables:
+            raise ValueError("No notes to train on.")
+        return cls(tables, order, grid)
+
+    @classmethod
+    def train(cls, paths, order=2, grid=0.125, workers=None):
+        # Count transitions in every midi file under paths, one file per task
+        # in a process pool (workers=1 counts in this process), then merge.
+        files = midi_files(paths)
+        if not files:
+            raise ValueError(f"No midi files found in {paths}.")
+        if workers == 1:
+            results = map(count_transitions, files, repeat(order), repeat(grid))
+        else:
+            with ProcessPoolExecutor(workers) as pool:
+                results = list(pool.map(count_transitions, files, repeat(order), repeat(grid)))
+        merged = {parameter: {} for parameter in PARAMETERS}
+        for counts in results:
+            for parameter, table in counts.items():
+                for context, successors in table.items():
+                    merged[parameter].setdefault(context, Counter()).update(successors)
+        return cls.from_counts(merged, order, grid)
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            pickle.dump({"format": MODEL_FORMAT, "model": self}, f, pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path):
+        # only load models you saved yourself, the file is unpickled
+        with open(path, "rb") as f:
+            data = pickle.load(f)
+        if not isinstance(data, dict) or data.get("format") != MODEL_FORMAT:
+            raise ValueError(f"{path} is not a Markov model file.")
+        return data["model"]
+
+
+class MarkovListGenerator:
+    # Same interface as savellysKone3.ListGenerator (generate_list,
+    # generate_batch, iter_list), so it can be passed to Song as a pitch,
+    # duration, velocity or (type "note") note generator. Lists are
+    # min_length values long, rounded up to an even length.
+    def __init__(self, model, type="pitch", min_length=8, seed=None, rng=None):
+        if isinstance(model, str):
+            model = MarkovModel.load(model)
+        if type not in model.tables:
+            raise ValueError(f"Model has no {type} table, use one of {', '.join(model.tables)}.")
+        self.model = model
+        self.type = type
+        self.table = model.tables[type]
+        self.min_length = min_length
+        self.list = []
+        if rng is None and seed is not None:
+            rng = random.Random(seed)
+        self.rng = rng
+
+    def generate_list(self, rng=None):
+        rng = rng or self.rng or random
+        length = self.min_length + self.min_length % 2
+        history = []
+        for _ in range(length):
+            history.append(self.table.sample(history, rng))
+        values = self.table.values
+        self.list = [values[i] for i in history]
+        return self.list
+
+    def generate_batch(self, n, rng=None):
+        # rng is one stream for the whole batch or a list of n streams
+        rng = rng or self.rng
+        rngs = rng if isinstance(rng, (list, tuple)) else [rng] * n
+        return [self.generate_list(item_rng) for item_rng in rngs]
+
+    def iter_list(self, rng=None, repeat=False):
+        # one list's worth of values, or an endless chain with repeat
+        rng = rng or self.rng or random
+        values = self.table.values
+        history = []
+        for _ in range(sys.maxsize if repeat else self.min_length + self.min_length % 2):
+            value = self.table.sample(history, rng)
+            yield values[value]
+            history.append(value)
+            if len(history) > self.table.order:
+                del history[0]
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (3, 4):
+        print("Usage: python3 markov_generator.py <midi_dir_or_file> <model_file> [order]")
+        sys.exit(1)
+
+    model = MarkovModel.train(sys.argv[1], int(sys.argv[3]) if len(sys.argv) == 4 else 2)
+    model.save(sys.argv[2])
+    print(f"Trained order-{model.order} model: " +
+          ", ".join(f"{len(table.values)} {parameter} values" for parameter, table in model.tables.items()))
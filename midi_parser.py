@@ -102,6 +102,40 @@ class MIDIParser:
         
         return self.note_events
     
+    def get_notes(self, grid: float = 0.125, skip_drums: bool = True) -> List[Tuple[int, float, int]]:
+        """
+        Pair note-on and note-off events into notes.
+        
+        Each note-off ends the earliest sounding note of the same pitch and
+        channel; notes that never end are left out. Parses the file first if
+        parse() has not been called.
+        
+        Args:
+            grid: Durations are rounded to this many beats (and at least one grid step)
+            skip_drums: If True, ignore the General MIDI drum channel (channel 10)
+            
+        Returns:
+            List of (pitch, duration_in_beats, velocity) tuples in onset order
+        """
+        if self.midi_file is None:
+            self.parse()
+        ticks_per_beat = self.midi_file.ticks_per_beat
+        sounding: Dict[Tuple[int, int], List[NoteEvent]] = {}
+        notes = []
+        for event in self.note_events:
+            if skip_drums and event.channel == 9:
+                continue
+            key = (event.channel, event.note)
+            if event.event_type == 'note_on':
+                sounding.setdefault(key, []).append(event)
+            elif sounding.get(key):
+                start = sounding[key].pop(0)
+                beats = (event.time - start.time) / ticks_per_beat
+                duration = max(grid, round(beats / grid) * grid)
+                notes.append((start.time, start.note, duration, start.velocity))
+        notes.sort()
+        return [(pitch, duration, velocity) for _, pitch, duration, velocity in notes]
+    
     def validate(self) -> Tuple[bool, List[ValidationError]]:
         """
         Validate that each note-on event has a corresponding note-off event
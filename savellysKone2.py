@@ -1,7 +1,6 @@
 from midiutil import MIDIFile
 import random, math
 import musical_scales as ms
-import gengramparser as ggp
 """
 acoustic
 aeolian
@@ -93,16 +92,43 @@ noteDict = {
     'C5': 84
 }
 
-def create_global_tonelist():
-    with open("in_grammar.txt") as in_grammar_file:
-        grammar = ggp.parse_grammar(in_grammar_file)
-    in_grammar_file.close()
-    globalToneList = ggp.generate(grammar, "S", 256)
+#grammar the global tone list is generated from, relative to the working directory
+grammarPath = "in_grammar.txt"
+
+#grammar path -> generated tone list, see get_global_tonelist
+_toneLists = {}
+
+def create_global_tonelist(path=None):
+    #compiled once into <path>.ggc, then read from there; the grammar engine
+    #(and numpy with it) is only imported when a tone list is needed
+    import gengramparser2 as ggp
+    grammar, compiled = ggp.load_grammar_file(path or grammarPath, "S", dialect="char")
+    globalToneList = ggp.generate_compiled(compiled, "S", 256)
     globalToneList = globalToneList.split()
     globalToneList = [int(note) for note in globalToneList]
     return globalToneList
 
-globalToneList = create_global_tonelist()
+def get_global_tonelist(path=None):
+    #generated on first use and shared by every Bar and Song after that;
+    #call clear_global_tonelist() for a fresh one. a list assigned to
+    #savellysKone2.globalToneList is used instead of the default grammar's
+    if path is None and "globalToneList" in globals():
+        return globals()["globalToneList"]
+    path = path or grammarPath
+    toneList = _toneLists.get(path)
+    if toneList is None:
+        toneList = _toneLists[path] = create_global_tonelist(path)
+    return toneList
+
+def clear_global_tonelist():
+    _toneLists.clear()
+    return
+
+def __getattr__(name):
+    #globalToneList used to be computed at import, keep it readable
+    if name == "globalToneList":
+        return get_global_tonelist()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 class Note:
     def __init__(self):
@@ -122,8 +148,10 @@ class Bar:
         self.endTime = self.bar_onset + self.duration*self.interOnsetInterval
         return
 
-    def generateNoteList(self):
-        self.fillNoteList(globalToneList)
+    def generateNoteList(self, toneList=None):
+        if toneList is None:
+            toneList = get_global_tonelist()
+        self.fillNoteList(toneList)
         return
         
     def fillNoteList(self, toneList):
@@ -202,15 +230,18 @@ class Bar:
         return
     
 class Song:
-    def __init__(self, numBars=4):
+    def __init__(self, numBars=4, grammarPath=None):
         self.barList = []
         self.numBars = numBars
+        #None uses the module's grammarPath
+        self.grammarPath = grammarPath
         return
 
     def generateBarList(self):
+        toneList = get_global_tonelist(self.grammarPath)
         for i in range(self.numBars):
             b = Bar(8, 1.0, i*8)
-            b.generateNoteList()
+            b.generateNoteList(toneList)
             self.barList.append(b)
         return
 
@@ -5,32 +5,221 @@
 from midiutil import MIDIFile
 import random
 import math
+import itertools
 import musical_scales as ms
 import sys
 import gengramparser2 as ggp
 
 
 class ListGenerator:
-    def __init__(self, grammar_str, min_length=8, type="pitch"):
+    def __init__(self, grammar_str, min_length=8, type="pitch", seed=None, rng=None, max_attempts=1000,
+                 sampling="rejection", max_length=None, max_tokens=100000, max_time=None,
+                 constraints=None, max_backtracks=1000, provenance=False):
         self.type = type
-        self.grammar = ggp.parse_grammar(grammar_str.split("\n"))
+        # parsed grammars are cached by text, so rebuilding a generator for
+        # the same grammar (as the GUI does on every click) skips parsing.
+        # Terminals are checked and converted to numbers once, here; a bad
+        # one raises ValueError with its line number.
+        terminal_type = type if type in ggp.TERMINAL_TYPES else None
+        self.grammar, self.compiled = ggp.load_grammar(grammar_str, terminal_type=terminal_type)
         self.min_length = min_length
         self.list = []
+        self.passes = 0
+        # own stream if seeded, otherwise the module-level random
+        if rng is None and seed is not None:
+            rng = random.Random(seed)
+        self.rng = rng
+        self.max_attempts = max_attempts
+        # a derivation that is still unfinished after 64 passes or grows past
+        # max_tokens is thrown away like a list of the wrong length
+        self.max_tokens = max_tokens
+        self.max_time = max_time
+        self.rejection_rate = self.check_length_constraints()
+        # generate from a copy with single-choice rules spliced in and dead or
+        # unreachable rules removed; self.optimization says what was folded.
+        # With provenance the rule chains recorded for each value
+        # (self.provenance, a ggp.Provenance; self.batch_provenance after
+        # generate_batch) are unfolded back onto the grammar's own rules, so
+        # recording them does not change the generated values.
+        self.record_provenance = provenance
+        self.provenance = None
+        self.batch_provenance = []
+        self.source_compiled = self.compiled
+        self.compiled, self.optimization = ggp.optimize_grammar(self.compiled)
+        # "rejection" regenerates until the length fits, "conditioned" only
+        # draws lists of an allowed length (up to max_length for grammars
+        # without a longest output, 256 by default)
+        self.sampling = sampling
+        self.max_length = max_length
+        self.sampler = None
+        if sampling == "conditioned":
+            self.sampler = self.make_conditioned_sampler()
+        elif sampling != "rejection":
+            raise ValueError(f"Unknown sampling mode '{sampling}', use 'rejection' or 'conditioned'.")
+        # ggp.Constraint objects (MaxInterval, ValueRange, NoRepeat, ...)
+        # checked value by value during the derivation, backing up to the
+        # latest choice on a violation; a derivation that needs more than
+        # max_backtracks re-samples is started over like a too-short list
+        self.constraints = list(constraints or [])
+        self.max_backtracks = max_backtracks
+        self.backtracks = 0
+        self.restarts = 0
+        if self.constraints and self.sampler:
+            raise ValueError("Constraints need sampling='rejection'.")
+        if provenance and (self.constraints or self.sampler):
+            raise ValueError("Provenance is only recorded with sampling='rejection' and no constraints.")
 
-    def generate_list(self):
+    def make_conditioned_sampler(self):
+        longest = ggp.analyze_lengths(self.compiled).max_length("$S")
+        if longest == math.inf:
+            longest = max(256, 2 * self.min_length)
+        if self.max_length is not None:
+            longest = min(longest, self.max_length)
+        lengths = [length for length in range(self.min_length, int(longest) + 1) if length % 2 == 0]
+        return ggp.conditioned_sampler(self.compiled, "$S", lengths)
+
+    def check_length_constraints(self):
+        # Fail fast when the grammar can never give an even-length list of at
+        # least min_length values; otherwise return the expected share of
+        # generated lists that generate_list has to throw away.
+        analysis = ggp.analyze_lengths(self.compiled)
+        shortest = analysis.min_length("$S")
+        longest = analysis.max_length("$S")
+        if shortest == math.inf:
+            raise ggp.GenerationError("Grammar cannot derive a finite list from '$S'.")
+        if longest < self.min_length:
+            raise ggp.GenerationError(f"Grammar produces at most {longest} {self.type} values, "
+                                      f"but min_length is {self.min_length}.")
+        if not analysis.parity("$S") & ggp.EVEN:
+            raise ggp.GenerationError(f"Grammar only produces odd-length {self.type} lists, "
+                                      f"but lists must have an even length.")
+        limit = longest if longest != math.inf else self.min_length + 256
+        if not any(length >= self.min_length and length % 2 == 0
+                   for length in analysis.possible_lengths("$S", int(limit))):
+            raise ggp.GenerationError(f"Grammar cannot produce an even-length {self.type} list of "
+                                      f"{self.min_length} to {int(limit)} values.")
+        rejection_rate = ggp.estimate_rejection_rate(self.compiled, "$S", self.min_length)
+        if rejection_rate >= 1.0:
+            raise ggp.GenerationError(f"Grammar never finishes with an even-length {self.type} list "
+                                      f"of at least {self.min_length} values.")
+        return rejection_rate
+
+    def retries_exhausted(self, attempts):
+        return ggp.GenerationError(f"No even-length {self.type} list of at least {self.min_length} values "
+                                   f"after {attempts} attempts (expected rejection rate "
+                                   f"{self.rejection_rate:.1%}).")
+
+    def generate_list(self, rng=None):
+        rng = rng or self.rng
+        if self.sampler:
+            self.list = self.values(self.sampler.sample(rng))
+            return self.list
         self.list = []
+        attempts = 0
         #powers_of_two = [2**i for i in range(10)]
         while (len(self.list) < self.min_length) or (len(self.list)%2 != 0):
-            self.list = ggp.generate(self.grammar, "$S", 64)
-            self.list = self.list.split()
-            if self.type == "pitch":
-                self.list = [int(note) for note in self.list]
-            elif self.type == "duration": 
-                self.list = [float(note) for note in self.list]
-            elif self.type == "velocity":
-                self.list = [int(note) for note in self.list]
+            if attempts == self.max_attempts:
+                raise self.retries_exhausted(attempts)
+            attempts += 1
+            if attempts > 1:
+                self.restarts += 1
+            try:
+                if self.constraints:
+                    ids, backtracks = ggp.derive_constrained(self.compiled, "$S", self.constraints, rng,
+                                                             self.max_backtracks, self.max_tokens, self.max_time)
+                    self.backtracks += backtracks
+                elif self.record_provenance:
+                    ids, self.passes, traced = ggp.derive_ids_traced(
+                        self.compiled, "$S", 64, rng, self.max_tokens, 64, self.max_time)
+                    self.provenance = ggp.unfold_provenance(self.source_compiled, self.optimization, traced, "$S")
+                else:
+                    ids, self.passes = ggp.derive_ids(self.compiled, "$S", 64, rng, self.max_tokens, 64,
+                                                      self.max_time)
+            except ggp.BudgetExceededError as e:
+                if e.budget == "time":
+                    raise
+                self.list = []
+                continue
+            self.list = self.values(ids)
         return self.list
 
+    def constraint_stats(self):
+        # rejections per constraint, plus backtracks and whole-list restarts
+        stats = {constraint.name: constraint.rejections for constraint in self.constraints}
+        stats["backtracks"] = self.backtracks
+        stats["restarts"] = self.restarts
+        return stats
+
+    def lookup(self):
+        # id -> list value: the precomputed numbers, or the tokens themselves
+        # for list types without a terminal type
+        if self.type in ggp.TERMINAL_TYPES:
+            return self.compiled.values
+        return self.compiled.symbols
+
+    def values(self, ids):
+        lookup = self.lookup()
+        return [lookup[i] for i in ids]
+
+    def iter_list(self, rng=None, repeat=False):
+        # The values of a derivation as the grammar produces them, without
+        # building the list first; with repeat, derivations follow each other
+        # without end. min_length and the even-length rule do not apply here,
+        # and no provenance is recorded.
+        rng = rng or self.rng
+        if self.constraints:
+            # a value is only final once the whole list passed, so no streaming
+            while True:
+                yield from self.generate_list(rng)
+                if not repeat:
+                    return
+        while True:
+            produced = False
+            lookup = self.lookup()
+            for symbol_id in ggp.iter_ids(self.compiled, "$S", rng):
+                produced = True
+                yield lookup[symbol_id]
+            if not repeat or not produced:
+                return
+
+    def generate_batch(self, n, rng=None):
+        # n lists in one batched derivation. rng is one stream for the whole
+        # batch or a list of n streams (list i then equals generate_list(rng[i])).
+        rng = rng or self.rng
+        if self.sampler or self.constraints or self.record_provenance:
+            rngs = rng if isinstance(rng, (list, tuple)) else [rng] * n
+            lists = []
+            self.batch_provenance = []
+            for item_rng in rngs:
+                lists.append(self.generate_list(item_rng))
+                self.batch_provenance.append(self.provenance)
+            if lists:
+                self.list = lists[-1]
+            return lists
+        lists = [None] * n
+        pending = list(range(n))
+        attempts = 0
+        while pending:
+            if attempts == self.max_attempts:
+                raise self.retries_exhausted(attempts)
+            attempts += 1
+            batch_rng = [rng[i] for i in pending] if isinstance(rng, (list, tuple)) else rng
+            sequences, self.passes = ggp.derive_batch(self.compiled, "$S", len(pending), 64, batch_rng,
+                                                      self.max_tokens, 64, self.max_time, drop_over_budget=True)
+            rejected = []
+            for i, ids in zip(pending, sequences):
+                if ids is None:
+                    rejected.append(i)
+                    continue
+                if len(ids) < self.min_length or len(ids) % 2 != 0:
+                    rejected.append(i)
+                else:
+                    lists[i] = self.values(ids)
+            pending = rejected
+        if lists:
+            self.list = lists[-1]
+        return lists
+
 class Note:
     def __init__(self):
         self.pitch = 60
@@ -40,13 +229,33 @@ class Note:
         return    
     
 class Bar:
-    def __init__(self, onset=0, ioi=0.75, pitch_list=None, duration_list=None, velocity_list=None):
+    def __init__(self, onset=0, ioi=0.75, pitch_list=None, duration_list=None, velocity_list=None, provenance=None):
         self.pitch_list = pitch_list
         self.duration_list = duration_list
         self.velocity_list = velocity_list
         self.note_list = []
         self.bar_onset = onset
         self.ioi = ioi
+        # parameter ("pitch", "duration", "velocity" or "note") -> ggp.Provenance
+        # of the generated list, for generators created with provenance=True
+        self.provenance = provenance or {}
+
+    def note_rules(self, i, parameter="pitch"):
+        # Rules that produced the parameter of note i, outermost first. Note
+        # indices are positions in the generated lists; lists that were looped
+        # to fill the bar repeat their provenance too.
+        provenance = self.provenance.get(parameter)
+        if provenance is None:
+            return []
+        return provenance.rules(i % len(provenance))
+
+    def notes_from_rule(self, symbol, parameter="pitch"):
+        # indices of the notes whose parameter came out of an expansion of symbol
+        provenance = self.provenance.get(parameter)
+        if provenance is None:
+            return []
+        hits = set(provenance.tokens_from(symbol))
+        return [i for i in range(len(self.pitch_list)) if i % len(provenance) in hits]
 
     def make_note_list(self):
         self.note_list = []
@@ -82,32 +291,36 @@ class Bar:
                 note.pitch = 127
         return
     
-    def random_pitch(self):
+    def random_pitch(self, rng=None):
+        rng = rng or random
         for i in range(len(self.note_list)):
-            self.note_list[i].pitch += random.randint(-3, 3)
+            self.note_list[i].pitch += rng.randint(-3, 3)
             if self.note_list[i].pitch < 0:
                 self.note_list[i].pitch = 0
             if self.note_list[i].pitch > 127:
                 self.note_list[i].pitch = 127
         return
     
-    def random_onset(self):
+    def random_onset(self, rng=None):
+        rng = rng or random
         for i in range(len(self.note_list)):
-            self.note_list[i].onset += (random.random()-0.5)*0.8
+            self.note_list[i].onset += (rng.random()-0.5)*0.8
             if self.note_list[i].onset < 0:
                 self.note_list[i].onset = 0
         return
     
-    def random_duration(self):
+    def random_duration(self, rng=None):
+        rng = rng or random
         for i in range(len(self.note_list)):
-            self.note_list[i].duration += (random.random()-0.5)*0.8
+            self.note_list[i].duration += (rng.random()-0.5)*0.8
             if self.note_list[i].duration < 0:
                 self.note_list[i].duration = 0
         return
     
-    def random_velocity(self):
+    def random_velocity(self, rng=None):
+        rng = rng or random
         for i in range(len(self.note_list)):
-            self.note_list[i].velocity += random.randint(-20, 20)
+            self.note_list[i].velocity += rng.randint(-20, 20)
             if self.note_list[i].velocity < 0:
                 self.note_list[i].velocity = 0
             if self.note_list[i].velocity > 127:
@@ -115,8 +328,12 @@ class Bar:
         return
     
     
+def split_notes(notes):
+    # (pitch, duration, velocity) tuples -> three parameter lists
+    return [note[0] for note in notes], [note[1] for note in notes], [note[2] for note in notes]
+
 class Song:
-    def __init__(self, name="skTrack", num_bars=4, ioi=1.0, pitch_generator=None, duration_generator=None, velocity_generator=None, generate_every_bar=False, list_length_behavior="truncate"):
+    def __init__(self, name="skTrack", num_bars=4, ioi=1.0, pitch_generator=None, duration_generator=None, velocity_generator=None, generate_every_bar=False, list_length_behavior="truncate", seed=None, rng=None, note_generator=None):
         self.name = name
         self.bar_list = []
         self.ioi = ioi
@@ -124,32 +341,112 @@ class Song:
         self.pitch_generator = pitch_generator
         self.duration_generator = duration_generator
         self.velocity_generator = velocity_generator
+        # a ListGenerator of type "note" makes all three lists in one
+        # derivation; they always match, so list_length_behavior is not needed
+        self.note_generator = note_generator
+        # provenance of the current lists, and of each bar's lists after
+        # generate_parameter_batches, for generators that record it
+        self.provenance = {}
+        self.batch_provenance = {}
         self.pitch_list = []
         self.duration_list = []
         self.velocity_list = []
         self.generate_every_bar = generate_every_bar
         self.list_length_behavior = list_length_behavior  # "truncate", "loop_longest", "loop_bar"
+        # With a seed every bar and parameter draws from its own derived
+        # stream (see child_rng), so bars can be rendered in any order or in
+        # separate processes and still come out the same.
+        if seed is None and rng is not None:
+            seed = rng.getrandbits(64)
+        self.seed = seed
+        # keys -> number of streams handed out for them, see call_rng
+        self.rng_calls = {}
+
+    def child_rng(self, *keys):
+        if self.seed is None:
+            return None
+        return ggp.derive_rng(self.seed, *keys)
 
-    def generate_parameter_lists(self):
+    def call_rng(self, *keys):
+        # child_rng for one more call with these keys: the first call gets
+        # child_rng(*keys), every later one a new stream numbered after it,
+        # so repeating a call moves the song on while the whole sequence of
+        # calls stays reproducible from the seed
+        if self.seed is None:
+            return None
+        count = self.rng_calls.get(keys, 0)
+        self.rng_calls[keys] = count + 1
+        return self.child_rng(*keys, count) if count else self.child_rng(*keys)
+
+    def generators(self):
+        # (parameter, generator) for the generators in use
+        if self.note_generator:
+            return [("note", self.note_generator)]
+        return [(parameter, generator) for parameter, generator in (("pitch", self.pitch_generator),
+                                                                   ("duration", self.duration_generator),
+                                                                   ("velocity", self.velocity_generator))
+                if generator]
+
+    def recorded(self, attribute):
+        # parameter -> generator.<attribute> for generators recording provenance
+        return {parameter: getattr(generator, attribute) for parameter, generator in self.generators()
+                if getattr(generator, "record_provenance", False)}
+
+    def generate_parameter_lists(self, bar_index=None):
+        if self.note_generator:
+            notes = self.note_generator.generate_list(self.call_rng("bar", bar_index, "note"))
+            self.pitch_list, self.duration_list, self.velocity_list = split_notes(notes)
+            self.provenance = self.recorded("provenance")
+            print(f"    Generated note lists: {len(notes)} notes")
+            return
         if self.pitch_generator:
-            self.pitch_list = self.pitch_generator.generate_list()
+            self.pitch_list = self.pitch_generator.generate_list(self.call_rng("bar", bar_index, "pitch"))
             print(f"    Generated pitch_list: {len(self.pitch_list)} notes")
         else:
             self.pitch_list = [60]*8
             print(f"    Using default pitch_list: {len(self.pitch_list)} notes")
         if self.duration_generator:
-            self.duration_list = self.duration_generator.generate_list()
+            self.duration_list = self.duration_generator.generate_list(self.call_rng("bar", bar_index, "duration"))
             print(f"    Generated duration_list: {len(self.duration_list)} notes")
         else:
             self.duration_list = [1]*8
             print(f"    Using default duration_list: {len(self.duration_list)} notes")
         if self.velocity_generator:
-            self.velocity_list = self.velocity_generator.generate_list()
+            self.velocity_list = self.velocity_generator.generate_list(self.call_rng("bar", bar_index, "velocity"))
             print(f"    Generated velocity_list: {len(self.velocity_list)} notes")
         else:
             self.velocity_list = [100]*8
             print(f"    Using default velocity_list: {len(self.velocity_list)} notes")
+        self.provenance = self.recorded("provenance")
+        self.adjust_parameter_lists()
+        return
 
+    def generate_parameter_batches(self):
+        # One list per bar for each parameter, each generator making all of
+        # its lists in a single batch. A seeded song hands every bar its own
+        # stream, so the result matches generate_parameter_lists(i) per bar.
+        if self.note_generator:
+            rng = None
+            if self.seed is not None:
+                rng = [self.call_rng("bar", i, "note") for i in range(self.num_bars)]
+            bars = [split_notes(notes) for notes in self.note_generator.generate_batch(self.num_bars, rng)]
+            self.batch_provenance = self.recorded("batch_provenance")
+            return [[bar[j] for bar in bars] for j in range(3)]
+        batches = []
+        for parameter, generator, default in (("pitch", self.pitch_generator, 60),
+                                              ("duration", self.duration_generator, 1),
+                                              ("velocity", self.velocity_generator, 100)):
+            if generator:
+                rng = None
+                if self.seed is not None:
+                    rng = [self.call_rng("bar", i, parameter) for i in range(self.num_bars)]
+                batches.append(generator.generate_batch(self.num_bars, rng))
+            else:
+                batches.append([[default]*8 for _ in range(self.num_bars)])
+        self.batch_provenance = self.recorded("batch_provenance")
+        return batches
+
+    def adjust_parameter_lists(self):
         print(f"    Before adjustment: pitch={len(self.pitch_list)}, duration={len(self.duration_list)}, velocity={len(self.velocity_list)}")
         print(f"    List length behavior: {self.list_length_behavior}")
         
@@ -200,11 +497,20 @@ class Song:
         self.bar_list = []
         onset = 0
         print(f"DEBUG make_bar_list: num_bars={self.num_bars}, song.ioi={self.ioi}, generate_every_bar={self.generate_every_bar}")
+        if self.generate_every_bar:
+            pitch_lists, duration_lists, velocity_lists = self.generate_parameter_batches()
         for i in range(self.num_bars):
             if self.generate_every_bar:
-                self.generate_parameter_lists()
+                self.pitch_list = pitch_lists[i]
+                self.duration_list = duration_lists[i]
+                self.velocity_list = velocity_lists[i]
+                if not self.note_generator:
+                    self.adjust_parameter_lists()
                 print(f"  Bar {i}: Generated lists - pitch:{len(self.pitch_list)}, duration:{len(self.duration_list)}, velocity:{len(self.velocity_list)}")
-            bar = Bar(onset, self.ioi, self.pitch_list, self.duration_list, self.velocity_list)
+            provenance = self.provenance
+            if self.generate_every_bar:
+                provenance = {parameter: bars[i] for parameter, bars in self.batch_provenance.items()}
+            bar = Bar(onset, self.ioi, self.pitch_list, self.duration_list, self.velocity_list, provenance)
             bar.make_note_list()
             self.bar_list.append(bar)
             prev_onset = onset
@@ -212,7 +518,36 @@ class Song:
             print(f"  Bar {i}: onset was {prev_onset}, added {bar.ioi}*{len(bar.note_list)}={bar.ioi*len(bar.note_list)}, new onset={onset}")
         return
     
-    def make_midi_file(self, filename):
+    def iter_bars(self, notes_per_bar=8, num_bars=None):
+        # Bars of notes_per_bar notes built lazily from the generators'
+        # streams (ListGenerator.iter_list), so a long piece never holds more
+        # than one bar of generated values. Does not touch self.bar_list.
+        if num_bars is None:
+            num_bars = self.num_bars
+        if self.note_generator:
+            notes = self.note_generator.iter_list(self.call_rng("stream", "note"), repeat=True)
+        else:
+            streams = []
+            for parameter, generator, default in (("pitch", self.pitch_generator, 60),
+                                                  ("duration", self.duration_generator, 1),
+                                                  ("velocity", self.velocity_generator, 100)):
+                if generator:
+                    streams.append(generator.iter_list(self.call_rng("stream", parameter), repeat=True))
+                else:
+                    streams.append(itertools.repeat(default))
+            notes = zip(*streams)
+        onset = 0
+        for i in range(num_bars):
+            chunk = list(itertools.islice(notes, notes_per_bar))
+            if len(chunk) < notes_per_bar:
+                return
+            pitch_list, duration_list, velocity_list = split_notes(chunk)
+            bar = Bar(onset, self.ioi, pitch_list, duration_list, velocity_list)
+            bar.make_note_list()
+            onset += bar.ioi*len(bar.note_list)
+            yield bar
+
+    def make_midi_file(self, filename, bars=None):
         # Create MIDI file with 1 track, format 0 (single track)
         # Disable removeDuplicates to ensure all notes are written
         midi_file = MIDIFile(numTracks=1, removeDuplicates=False, deinterleave=False, 
@@ -225,7 +560,10 @@ class Song:
         # Debug: Print onset times for first few bars
         note_count = 0
         notes_at_time = {}  # Track how many notes at each onset
-        for bar_idx, bar in enumerate(self.bar_list):
+        # bars may be any iterable, e.g. iter_bars(); defaults to bar_list
+        if bars is None:
+            bars = self.bar_list
+        for bar_idx, bar in enumerate(bars):
             if bar_idx < 3:  # Print first 3 bars for debugging
                 print(f"Bar {bar_idx}: bar_onset={bar.bar_onset}, num_notes={len(bar.note_list)}")
                 if bar.note_list:
@@ -269,27 +607,27 @@ class Song:
         return
     
     def random_pitch(self):
-        for bar in self.bar_list:
-            bar.random_pitch()
+        for i, bar in enumerate(self.bar_list):
+            bar.random_pitch(self.call_rng("bar", i, "random_pitch"))
         return
     
     def random_onset(self):
-        for bar in self.bar_list:
-            bar.random_onset()
+        for i, bar in enumerate(self.bar_list):
+            bar.random_onset(self.call_rng("bar", i, "random_onset"))
         return
     
     def random_duration(self):
-        for bar in self.bar_list:
-            bar.random_duration()
+        for i, bar in enumerate(self.bar_list):
+            bar.random_duration(self.call_rng("bar", i, "random_duration"))
         return
     
     def random_velocity(self):
-        for bar in self.bar_list:
-            bar.random_velocity()
+        for i, bar in enumerate(self.bar_list):
+            bar.random_velocity(self.call_rng("bar", i, "random_velocity"))
         return
     
     def random_bar_order(self):
-        random.shuffle(self.bar_list)
+        (self.call_rng("random_bar_order") or random).shuffle(self.bar_list)
         return
     
     def modulate_pitch_with_sin(self, freq, amp):
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""Tests for grammar_induction (Sequitur) and loading its grammars"""
+
+import os
+import random
+import tempfile
+
+import mido
+
+import gengramparser2 as ggp
+import grammar_induction as gi
+import savellysKone3 as sk3
+
+
+def expand(text):
+    return ggp.generate(ggp.parse_grammar(text.split("\n")), "$S", 1000).split()
+
+
+def test_repeats_become_rules():
+    assert gi.induce_grammar("abcdbcabcd") == "$S -> $A $B $A\n$A -> a $B d\n$B -> b c\n"
+    assert gi.induce_grammar("aaaaaaaa") == "$S -> $A $A\n$A -> $B $B\n$B -> a a\n"
+
+
+def test_grammars_reproduce_input():
+    for trial in range(100):
+        rng = random.Random(trial)
+        values = [rng.choice("abc") for _ in range(rng.randint(1, 200))]
+        text = gi.induce_grammar(values)
+        assert expand(text) == values
+        sequitur = gi.Sequitur()
+        sequitur.extend(values)
+        # rule utility: every rule but $S is used at least twice
+        assert all(rule.refs >= 2 for rule, _ in sequitur.rules()[1:])
+    rng = random.Random(5)
+    text = gi.induce_grammar([rng.randrange(3) for _ in range(400)])
+    names = set(line.split()[0] for line in text.split("\n") if line)
+    assert len(names) > 26 and "$AA" in names  # $S only names the start rule
+
+
+def test_grammar_from_midi_loads_in_list_generator():
+    melody = [(60, 0.5, 90), (62, 0.5, 90), (64, 1.0, 100), (60, 0.5, 90), (62, 0.5, 90), (67, 1.5, 100)] * 2
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "melody.mid")
+        mid = mido.MidiFile(ticks_per_beat=480)
+        track = mido.MidiTrack()
+        mid.tracks.append(track)
+        for pitch, beats, velocity in melody:
+            track.append(mido.Message("note_on", note=pitch, velocity=velocity, time=0))
+            track.append(mido.Message("note_off", note=pitch, velocity=0, time=int(beats * 480)))
+        mid.save(path)
+
+        pitch_grammar = gi.grammar_from_midi(path, "pitch")
+        assert pitch_grammar.startswith("%type pitch\n$S -> $A $A\n")
+        assert sk3.ListGenerator(pitch_grammar, 8, "pitch").generate_list() == [note[0] for note in melody]
+        durations = sk3.ListGenerator(gi.grammar_from_midi(path, "duration"), 8, "duration").generate_list()
+        assert durations == [note[1] for note in melody]
+        notes = sk3.ListGenerator(gi.grammar_from_midi(path, "note"), 8, "note").generate_list()
+        assert notes == melody
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_") and callable(test):
+            test()
+            print(f"✓ {name}")
+    print("\n✓ All grammar induction tests passed")
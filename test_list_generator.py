@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+"""Tests for savellysKone3.ListGenerator and Song list generation"""
+
+import random
+
+import gengramparser2 as ggp
+import savellysKone3 as sk3
+
+PITCH_GRAMMAR = """
+$S -> $phrase0 $phrase0
+$phrase0 -> $note0 $note1 $note0 $note1
+$note0 -> 60 | 62 | 64 | 65
+$note1 -> 67 | 69 | 71 | 72
+"""
+
+DURATION_GRAMMAR = """
+$S -> $d $d $d $d $d $d $d $d
+$d -> 0.25 | 0.5 | 1.0
+"""
+
+VELOCITY_GRAMMAR = """
+$S -> $v $v $v $v $v $v $v $v
+$v -> 60 | 80 | 100 | 120
+"""
+
+
+def make_song(seed, num_bars=4):
+    return sk3.Song(num_bars=num_bars,
+                    pitch_generator=sk3.ListGenerator(PITCH_GRAMMAR, 8, "pitch"),
+                    duration_generator=sk3.ListGenerator(DURATION_GRAMMAR, 8, "duration"),
+                    velocity_generator=sk3.ListGenerator(VELOCITY_GRAMMAR, 8, "velocity"),
+                    generate_every_bar=True,
+                    seed=seed)
+
+
+def bar_lists(song):
+    return [(bar.pitch_list, bar.duration_list, bar.velocity_list) for bar in song.bar_list]
+
+
+def test_seeded_generator_is_reproducible():
+    first = sk3.ListGenerator(PITCH_GRAMMAR, 8, "pitch", seed=42).generate_list()
+    second = sk3.ListGenerator(PITCH_GRAMMAR, 8, "pitch", seed=42).generate_list()
+    assert first == second
+    assert all(isinstance(p, int) for p in first)
+
+
+def test_seeded_song_is_reproducible():
+    song_a = make_song(seed=5)
+    song_a.make_bar_list()
+    random.random()  # the global stream must not matter
+    song_b = make_song(seed=5)
+    song_b.make_bar_list()
+    assert bar_lists(song_a) == bar_lists(song_b)
+
+
+def test_bars_do_not_depend_on_render_order():
+    serial = make_song(seed=9)
+    serial.make_bar_list()
+    expected = bar_lists(serial)
+
+    # render the bars back to front, as independent workers might
+    song = make_song(seed=9)
+    for i in reversed(range(song.num_bars)):
+        song.generate_parameter_lists(i)
+        assert (song.pitch_list, song.duration_list, song.velocity_list) == expected[i]
+
+
+def test_seeded_song_modifiers_are_reproducible():
+    pitches = []
+    for _ in range(2):
+        song = make_song(seed=3)
+        song.make_bar_list()
+        song.random_pitch()
+        song.random_bar_order()
+        pitches.append([note.pitch for bar in song.bar_list for note in bar.note_list])
+    assert pitches[0] == pitches[1]
+
+
+def test_repeated_seeded_calls_move_on():
+    runs = []
+    for _ in range(2):
+        song = make_song(seed=6, num_bars=8)
+        song.make_bar_list()
+        onsets = [[note.onset for note in song.bar_list[0].note_list]]
+        for _ in range(2):
+            song.random_onset()
+            onsets.append([note.onset for note in song.bar_list[0].note_list])
+        bars = list(song.bar_list)
+        orders = []
+        for _ in range(3):
+            song.random_bar_order()
+            orders.append([bars.index(bar) for bar in song.bar_list])
+        pitch_lists = []
+        for _ in range(2):
+            song.generate_parameter_lists()
+            pitch_lists.append(song.pitch_list)
+        runs.append((onsets, orders, pitch_lists))
+    onsets, orders, pitch_lists = runs[0]
+    # the second call draws new offsets instead of repeating the first ones
+    assert [b - a for a, b in zip(onsets[0], onsets[1])] != [c - b for b, c in zip(onsets[1], onsets[2])]
+    assert len({tuple(order) for order in orders}) > 1
+    assert pitch_lists[0] != pitch_lists[1]
+    assert runs[0] == runs[1]
+
+
+def test_generate_batch_respects_min_length():
+    generator = sk3.ListGenerator("$S -> 60 $S | 62 | 64 66", 4, "pitch", seed=1)
+    lists = generator.generate_batch(50)
+    assert len(lists) == 50
+    for values in lists:
+        assert len(values) >= 4 and len(values) % 2 == 0
+
+
+def test_generate_batch_per_item_streams_match_serial():
+    generator = sk3.ListGenerator(PITCH_GRAMMAR, 8, "pitch")
+    batch = generator.generate_batch(6, [random.Random(i) for i in range(6)])
+    serial = [generator.generate_list(random.Random(i)) for i in range(6)]
+    assert batch == serial
+
+
+def test_impossible_length_settings_fail_fast():
+    cases = [("$S -> 60 62 64 65", 8),                   # too short
+             ("$S -> 60 60 $S | 62 62 62", 4),           # odd lengths only
+             ("$S -> 60 62 | $T\n$T -> 60 60 $T | 60", 4),  # even lengths only below min_length
+             ("$S -> 60 $S", 2),                          # never finishes
+             ("$S -> 60 $S | 62 [0]", 2),                 # only a never-drawn alternative finishes
+             ("$S -> 60 60 $S | 62 $S [0] | 62", 2)]      # even lengths need a [0] alternative
+    for grammar, min_length in cases:
+        try:
+            sk3.ListGenerator(grammar, min_length, "pitch")
+        except ggp.GenerationError:
+            pass
+        else:
+            raise AssertionError(f"accepted impossible grammar {grammar!r}")
+
+
+def test_rejection_rate_and_retry_cap():
+    generator = sk3.ListGenerator("$S -> $A $B\n$A -> 60 | 60 62\n$B -> 64 | 64 65 67", 4, "pitch")
+    assert abs(generator.rejection_rate - 0.75) < 1e-9
+    assert sk3.ListGenerator(PITCH_GRAMMAR, 8, "pitch").rejection_rate == 0.0
+
+    generator = sk3.ListGenerator("$S -> 60 $S | 62", 40, "pitch", seed=2, max_attempts=5)
+    try:
+        generator.generate_list()
+    except ggp.GenerationError as e:
+        assert "after 5 attempts" in str(e)
+    else:
+        raise AssertionError("retry cap was not enforced")
+
+
+def test_conditioned_sampling_matches_rejection():
+    grammar = "$S -> $A $A\n$A -> 60 [3] | 62 62 [1] | 64 64 64 [2]"
+    conditioned = sk3.ListGenerator(grammar, 4, "pitch", seed=4, sampling="conditioned")
+    rejection = sk3.ListGenerator(grammar, 4, "pitch", seed=4)
+    # $A has lengths 1, 2, 3 with chances 1/2, 1/6, 1/3: of the two accepted
+    # lengths, 4 comes up 13/36 and 6 comes up 4/36 of the time
+    assert abs(conditioned.sampler.acceptance - 17 / 36) < 1e-9
+    for generator in (conditioned, rejection):
+        counts = {4: 0, 6: 0}
+        for _ in range(3000):
+            counts[len(generator.generate_list())] += 1
+        assert 0.72 < counts[4] / 3000 < 0.81
+
+
+def test_conditioned_sampling_recursive_grammar():
+    generator = sk3.ListGenerator("$S -> 60 $S | 62 $S | 64", 40, "pitch", seed=8,
+                                  sampling="conditioned", max_length=60)
+    for values in generator.generate_batch(20):
+        assert 40 <= len(values) <= 60 and len(values) % 2 == 0
+        assert values[-1] == 64 and 64 not in values[:-1]
+
+
+def test_streamed_lists_and_bars():
+    generator = sk3.ListGenerator("$S -> 60 $S | 62 $S | 64", 2, "pitch", seed=6)
+    values = list(generator.iter_list())
+    assert values[-1] == 64 and all(isinstance(v, int) for v in values)
+
+    # a right-recursive grammar that would take millions of tokens to finish
+    endless = sk3.ListGenerator("$S -> 60 $S [1000000] | 62", 2, "pitch", seed=1)
+    song = sk3.Song(num_bars=3, pitch_generator=endless, seed=2,
+                    duration_generator=sk3.ListGenerator(DURATION_GRAMMAR, 8, "duration"))
+    bars = list(song.iter_bars(notes_per_bar=4, num_bars=500))
+    assert len(bars) == 500
+    assert [bar.bar_onset for bar in bars[:3]] == [0, 4.0, 8.0]
+    assert all(len(bar.note_list) == 4 for bar in bars)
+    assert all(note.velocity == 100 for note in bars[0].note_list)
+
+
+def test_typed_terminals():
+    durations = sk3.ListGenerator(DURATION_GRAMMAR, 8, "duration", seed=1).generate_list()
+    assert all(type(d) is float for d in durations)
+    assert all(type(v) is int for v in sk3.ListGenerator(VELOCITY_GRAMMAR, 8, "velocity").generate_list())
+    for grammar, kind in (("$S -> 60 62\n$S -> 64 6O", "pitch"),   # letter O
+                          ("$S -> 60 62 | 64 130", "pitch"),
+                          ("$S -> $d $d\n$d -> 0.5 | $e", "duration")):
+        try:
+            sk3.ListGenerator(grammar, 2, kind)
+        except ValueError as e:
+            assert str(e).startswith("Line 2:" if "\n" in grammar else "Line 1:"), e
+        else:
+            raise AssertionError(f"accepted bad {kind} terminal in {grammar!r}")
+
+
+NOTE_GRAMMAR = """
+$S -> $phrase $phrase
+$phrase -> $low $high $low $high
+$low -> 60/0.5/80 | 62/0.5 | 64
+$high -> 67/1.0/110 | 72/0.25/120
+"""
+
+
+def test_note_grammar_song():
+    generator = sk3.ListGenerator(NOTE_GRAMMAR, 8, "note")
+    notes = generator.generate_list(random.Random(1))
+    assert len(notes) == 8 and notes[0] in ((60, 0.5, 80), (62, 0.5, 100), (64, 1.0, 100))
+
+    song = sk3.Song(num_bars=3, note_generator=generator, generate_every_bar=True, seed=4)
+    song.make_bar_list()
+    # a fresh song with the same seed renders the same bars one at a time
+    single = sk3.Song(num_bars=3, note_generator=generator, generate_every_bar=True, seed=4)
+    for i, bar in enumerate(song.bar_list):
+        assert len(bar.pitch_list) == len(bar.duration_list) == len(bar.velocity_list) == 8
+        single.generate_parameter_lists(i)
+        assert (single.pitch_list, single.duration_list, single.velocity_list) == \
+            (bar.pitch_list, bar.duration_list, bar.velocity_list)
+    bars = list(song.iter_bars(notes_per_bar=4, num_bars=6))
+    assert all(bar.note_list[1].pitch in (67, 72) for bar in bars)
+    try:
+        sk3.ListGenerator("$S -> 60/0.5/100/1 62", 2, "note")
+    except ValueError as e:
+        assert "Line 1" in str(e)
+    else:
+        raise AssertionError("accepted a note with four fields")
+
+
+def test_incremental_constraints():
+    grammar = "$S -> $n $n $n $n $n $n $n $n\n$n -> 48 | 55 | 60 | 62 | 64 | 67 | 72 | 79"
+    generator = sk3.ListGenerator(grammar, 8, "pitch", seed=3,
+                                  constraints=[ggp.MaxInterval(5), ggp.ValueRange(55, 72), ggp.NoRepeat(2)])
+    for values in generator.generate_batch(20):
+        assert len(values) == 8 and all(55 <= v <= 72 for v in values)
+        assert all(0 < abs(a - b) <= 5 for a, b in zip(values, values[1:]))
+    stats = generator.constraint_stats()
+    assert stats["max_interval"] > 0 and stats["range"] > 0 and stats["backtracks"] > 0
+    assert stats["restarts"] == 0
+
+    velocities = sk3.ListGenerator("$S -> $v $S | $v\n$v -> 80 [4] | 100", 8, "velocity", seed=1,
+                                   constraints=[ggp.NoRepeat(3)])
+    values = velocities.generate_list()
+    assert not any(a == b == c for a, b, c in zip(values, values[1:], values[2:]))
+
+    impossible = sk3.ListGenerator(grammar, 8, "pitch", constraints=[ggp.ValueRange(0, 40)])
+    try:
+        impossible.generate_list()
+    except ggp.GenerationError as e:
+        assert "range" in str(e)
+    else:
+        raise AssertionError("unsatisfiable constraint was not reported")
+
+
+def test_provenance():
+    traced = sk3.ListGenerator(PITCH_GRAMMAR, 8, "pitch", provenance=True)
+    plain = sk3.ListGenerator(PITCH_GRAMMAR, 8, "pitch")
+    assert traced.generate_list(random.Random(2)) == plain.generate_list(random.Random(2))
+    assert plain.provenance is None
+    provenance = traced.provenance
+    assert len(provenance) == 8
+    assert provenance.rules(1) == ["$S -> $phrase0 $phrase0", "$phrase0 -> $note0 $note1 $note0 $note1",
+                                   f"$note1 -> {traced.list[1]}"]
+    assert provenance.tokens_from("$note0") == [0, 2, 4, 6]
+
+    # rules folded or dropped by optimize_grammar still show up in the chains
+    folding = ("$S -> $phrase $phrase\n$phrase -> $n0 $n1 $n0 $end\n$n0 -> 60\n"
+               "$n1 -> 67 | 69 | $loop\n$loop -> 1 $loop\n$end -> $n0 72 [1] | 99 [0]")
+    for seed in range(20):
+        traced = sk3.ListGenerator(folding, 8, "pitch", seed=seed, provenance=True)
+        assert traced.generate_list() == sk3.ListGenerator(folding, 8, "pitch", seed=seed).generate_list()
+        provenance = traced.provenance
+        assert len(provenance) == 10 and provenance.compiled is traced.source_compiled
+        assert provenance.rules(3) == ["$S -> $phrase $phrase", "$phrase -> $n0 $n1 $n0 $end",
+                                       "$end -> $n0 72", "$n0 -> 60"]
+        assert provenance.tokens_from("$n1") == [1, 6] and provenance.rules(6)[-1] == f"$n1 -> {traced.list[6]}"
+
+    song = sk3.Song(num_bars=2, generate_every_bar=True, seed=1,
+                    pitch_generator=sk3.ListGenerator(PITCH_GRAMMAR, 8, "pitch", provenance=True),
+                    duration_generator=sk3.ListGenerator(DURATION_GRAMMAR, 8, "duration"))
+    song.make_bar_list()
+    bar = song.bar_list[1]
+    assert set(bar.provenance) == {"pitch"}
+    assert bar.notes_from_rule("$note1") == [1, 3, 5, 7]
+    assert bar.note_rules(3)[-1] == f"$note1 -> {bar.pitch_list[3]}"
+    assert bar.note_rules(3, "duration") == []
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_") and callable(test):
+            test()
+            print(f"✓ {name}")
+    print("\n✓ All ListGenerator tests passed")
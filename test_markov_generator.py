@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""Tests for markov_generator: training from MIDI, saving, and use in a Song"""
+
+import os
+import random
+import tempfile
+
+import mido
+
+import markov_generator as mg
+import savellysKone3 as sk3
+
+
+def write_midi(path, notes, ticks_per_beat=480):
+    # notes: (pitch, beats, velocity), played one after another
+    mid = mido.MidiFile(ticks_per_beat=ticks_per_beat)
+    track = mido.MidiTrack()
+    mid.tracks.append(track)
+    for pitch, beats, velocity in notes:
+        track.append(mido.Message("note_on", note=pitch, velocity=velocity, time=0))
+        track.append(mido.Message("note_off", note=pitch, velocity=0, time=int(beats * ticks_per_beat)))
+    mid.save(path)
+
+
+RISING = [(60, 0.5, 90), (62, 0.5, 90), (64, 1.0, 110), (65, 0.5, 90)] * 4
+FALLING = [(72, 0.25, 70), (71, 0.25, 70), (69, 0.5, 70)] * 4
+
+
+def train(directory, workers=1):
+    os.makedirs(os.path.join(directory, "corpus", "more"))
+    write_midi(os.path.join(directory, "corpus", "rising.mid"), RISING)
+    write_midi(os.path.join(directory, "corpus", "more", "falling.mid"), FALLING)
+    return mg.MarkovModel.train(os.path.join(directory, "corpus"), order=2, workers=workers)
+
+
+def test_read_notes():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "rising.mid")
+        write_midi(path, RISING)
+        assert mg.read_notes(path) == RISING
+
+
+def test_trained_chain_follows_corpus():
+    with tempfile.TemporaryDirectory() as directory:
+        model = train(directory)
+        pitches = mg.MarkovListGenerator(model, "pitch", 16, seed=1).generate_list()
+        # every learned transition is deterministic once the chain is in a corpus
+        allowed = {(60, 62), (62, 64), (64, 65), (65, 60), (72, 71), (71, 69), (69, 72)}
+        assert all(pair in allowed for pair in zip(pitches, pitches[1:]))
+        notes = mg.MarkovListGenerator(model, "note", 7, seed=2).generate_list()
+        assert len(notes) == 8 and all(note in RISING + FALLING for note in notes)
+
+        path = os.path.join(directory, "model.pkl")
+        model.save(path)
+        first = mg.MarkovListGenerator(path, "duration", seed=3).generate_list()
+        assert first == mg.MarkovListGenerator(model, "duration", seed=3).generate_list()
+
+        parallel = train(os.path.join(directory, "parallel"), workers=2)
+        assert parallel.tables["pitch"].cumulative == model.tables["pitch"].cumulative
+
+
+def test_markov_generators_in_song():
+    with tempfile.TemporaryDirectory() as directory:
+        model = train(directory)
+        song = sk3.Song(num_bars=3, generate_every_bar=True, seed=5,
+                        note_generator=mg.MarkovListGenerator(model, "note"))
+        song.make_bar_list()
+        assert all(len(bar.note_list) == 8 for bar in song.bar_list)
+
+        song = sk3.Song(num_bars=2, seed=6,
+                        pitch_generator=mg.MarkovListGenerator(model, "pitch"),
+                        velocity_generator=mg.MarkovListGenerator(model, "velocity"))
+        bars = list(song.iter_bars(notes_per_bar=4, num_bars=10))
+        assert len(bars) == 10
+        assert {note.velocity for bar in bars for note in bar.note_list} <= {70, 90, 110}
+        batch = mg.MarkovListGenerator(model, "pitch").generate_batch(3, [random.Random(i) for i in range(3)])
+        assert batch[1] == mg.MarkovListGenerator(model, "pitch").generate_list(random.Random(1))
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_") and callable(test):
+            test()
+            print(f"✓ {name}")
+    print("\n✓ All Markov generator tests passed")
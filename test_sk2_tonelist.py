@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""Tests for savellysKone2's lazily generated global tone list"""
+
+import os
+import subprocess
+import sys
+import tempfile
+
+import savellysKone2 as sk2
+
+
+def test_import_does_no_work():
+    # the module imports without in_grammar.txt and without the grammar engine
+    here = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as directory:
+        subprocess.run([sys.executable, "-c", "import sys, savellysKone2; assert 'gengramparser2' not in sys.modules"],
+                       cwd=directory, env=dict(os.environ, PYTHONPATH=here), check=True)
+    bar = sk2.Bar()
+    bar.fillNoteList([60, 62])
+    assert [note.pitch for note in bar.noteList] == [60, 62]
+
+
+def test_tonelist_is_generated_once_and_shared():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "melody.txt")
+        with open(path, "w") as f:
+            f.write("S -> 60 A\nA -> 62 B | 64 B\nB -> 67\n")
+        sk2.clear_global_tonelist()
+        first = sk2.Song(2, grammarPath=path)
+        first.generateBarList()
+        toneList = sk2.get_global_tonelist(path)
+        assert toneList[0] == 60 and toneList[2] == 67 and len(toneList) == 3
+        second = sk2.Song(3, grammarPath=path)
+        second.generateBarList()
+        assert sk2.get_global_tonelist(path) is toneList
+        assert [note.pitch for note in second.barList[2].noteList] == toneList
+
+        grammarPath = sk2.grammarPath
+        sk2.grammarPath = path
+        try:
+            assert sk2.globalToneList is toneList
+        finally:
+            sk2.grammarPath = grammarPath
+            sk2.clear_global_tonelist()
+
+
+def test_assigned_tonelist_overrides_grammar():
+    sk2.globalToneList = [48, 50, 52]
+    try:
+        bar = sk2.Bar()
+        bar.generateNoteList()
+        assert [note.pitch for note in bar.noteList] == [48, 50, 52]
+        song = sk2.Song(2)
+        song.generateBarList()
+        assert [note.pitch for note in song.barList[1].noteList] == [48, 50, 52]
+    finally:
+        del sk2.globalToneList
+    assert "globalToneList" not in vars(sk2)
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_") and callable(test):
+            test()
+            print(f"✓ {name}")
+    print("\n✓ All savellysKone2 tone list tests passed")
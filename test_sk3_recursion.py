@@ -14,7 +14,7 @@ $note02 -> 62
 $note03 -> 64
 $note04 -> 65"""
     
-    gen = sk3.ListGenerator(valid_grammar, 8, "pitch")
+    gen = sk3.ListGenerator(valid_grammar, 4, "pitch")
     result = gen.generate_list()
     print(f"✓ Valid grammar works. Generated list: {result}")
 except Exception as e: